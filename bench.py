@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, sys
+import contextlib
+import json
+import math
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from laser import SampleBuffer
+from main import load_svg, encode_frame, write_ild_sections
+from render_parameters import RenderParameters
+import svg
+
+# subpath counts for the synthetic cases; 10000 and 100000 only with -full
+SCALES = (10, 100, 1000)
+FULL_SCALES = SCALES + (10000, 100000)
+STAGES = ("parse", "sort", "render", "encode", "write")
+# large frames are encoded as several sections, to stay below the ILDA limit
+SECTION_POINTS = 60000
+
+
+def svg_document(elements):
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="1000" height="1000" viewBox="0 0 1000 1000">\n'
+            + "\n".join(elements) + "\n</svg>\n")
+
+def gen_curves(rnd, n):
+    # closed paths of dense cubic curves
+    out = []
+    for _ in range(n):
+        x, y = rnd.uniform(100, 900), rnd.uniform(100, 900)
+        d = ["M%.3f,%.3f"%(x, y)]
+        for _ in range(8):
+            d.append("c%.3f,%.3f %.3f,%.3f %.3f,%.3f"%tuple(rnd.uniform(-40, 40) for _ in range(6)))
+        d.append("Z")
+        out.append('<path d="%s" stroke="black" fill="none"/>'%" ".join(d))
+    return out
+
+def gen_polylines(rnd, n):
+    # long polylines of short, nearly collinear steps
+    out = []
+    for _ in range(n):
+        x, y = rnd.uniform(0, 1000), rnd.uniform(0, 1000)
+        a = rnd.uniform(0, 2*math.pi)
+        points = []
+        for _ in range(50):
+            a += rnd.uniform(-0.2, 0.2)
+            x = min(1000, max(0, x + 2*math.cos(a)))
+            y = min(1000, max(0, y + 2*math.sin(a)))
+            points.append("%.3f,%.3f"%(x, y))
+        out.append('<polyline points="%s" stroke="black" fill="none"/>'%" ".join(points))
+    return out
+
+def gen_shapes(rnd, n):
+    # many small rectangles, circles and lines
+    out = []
+    for i in range(n):
+        x, y = rnd.uniform(0, 990), rnd.uniform(0, 990)
+        s = rnd.uniform(1, 10)
+        if i % 3 == 0:
+            out.append('<rect x="%.3f" y="%.3f" width="%.3f" height="%.3f" stroke="black" fill="none"/>'%(x, y, s, s))
+        elif i % 3 == 1:
+            out.append('<circle cx="%.3f" cy="%.3f" r="%.3f" stroke="black" fill="none"/>'%(x, y, s/2))
+        else:
+            out.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="black"/>'%(x, y, x+s, y+s))
+    return out
+
+def gen_arcs(rnd, n):
+    # paths of elliptical arcs
+    out = []
+    for _ in range(n):
+        x, y = rnd.uniform(100, 900), rnd.uniform(100, 900)
+        d = ["M%.3f,%.3f"%(x, y)]
+        for _ in range(4):
+            d.append("a%.3f,%.3f %.1f %d,%d %.3f,%.3f"%(rnd.uniform(5, 40), rnd.uniform(5, 40), rnd.uniform(0, 360),
+                                                          rnd.randint(0, 1), rnd.randint(0, 1),
+                                                          rnd.uniform(-40, 40), rnd.uniform(-40, 40)))
+        out.append('<path d="%s" stroke="black" fill="none"/>'%" ".join(d))
+    return out
+
+def gen_clustered(rnd, n):
+    # a border around the page and short strokes packed into a small patch
+    # of it, like a line of text or a hatch fill in a large, empty frame
+    out = ['<rect x="0" y="0" width="1000" height="1000" stroke="black" fill="none"/>']
+    side = 20.0
+    for _ in range(n):
+        x, y = rnd.uniform(100, 100 + side), rnd.uniform(100, 100 + side)
+        out.append('<line x1="%.3f" y1="%.3f" x2="%.3f" y2="%.3f" stroke="black"/>'%(
+            x, y, x + rnd.uniform(-0.5, 0.5), y + rnd.uniform(-0.5, 0.5)))
+    return out
+
+GENERATORS = {
+    "curves": gen_curves,
+    "polylines": gen_polylines,
+    "shapes": gen_shapes,
+    "arcs": gen_arcs,
+    "clustered": gen_clustered,
+}
+
+def write_cases(directory, scales):
+    # deterministic synthetic SVGs: the same name always gives the same file
+    cases = []
+    for kind, gen in sorted(GENERATORS.items()):
+        for n in scales:
+            name = "%s-%d"%(kind, n)
+            path = os.path.join(directory, name + ".svg")
+            with open(path, "w") as f:
+                f.write(svg_document(gen(random.Random(name), n)))
+            cases.append((name, [path]))
+    return cases
+
+def sections(rframe, size=SECTION_POINTS):
+    for i in range(0, len(rframe), size):
+        buf = SampleBuffer()
+        buf.x = rframe.x[i:i+size]
+        buf.y = rframe.y[i:i+size]
+        buf.on = rframe.on[i:i+size]
+        yield buf
+
+def run_case(params, svg_paths, out_path, memory=False):
+    # one pass over every stage; returns {stage: (seconds, peak bytes)}
+    # and the number of points rendered
+    stages = dict((stage, [0.0, 0]) for stage in STAGES)
+    def measure(stage, func, *args):
+        if memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func(*args)
+        stages[stage][0] += time.perf_counter() - start
+        if memory:
+            stages[stage][1] = max(stages[stage][1], tracemalloc.get_traced_memory()[1])
+        return result
+    svg.path_cache.clear()
+    points = 0
+    encoded = []
+    for frame_index, svg_path in enumerate(svg_paths):
+        params.reset_stats()
+        frame = measure("parse", load_svg, svg_path)
+        measure("sort", frame.sort)
+        measure("sort", frame.refine, params)
+        rframe = measure("render", frame.render, params)
+        points += len(rframe)
+        for buf in sections(rframe):
+            encoded.append(measure("encode", encode_frame, params, buf, len(encoded), 0))
+        del frame, rframe
+    measure("write", write_ild_sections, encoded, out_path)
+    return stages, points
+
+def benchmark(params, cases, repeat=3):
+    # best wall time of repeat runs, and the peak memory of one traced run
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, "out.ild")
+        for name, svg_paths in cases:
+            best = None
+            for _ in range(repeat):
+                stages, points = run_case(params, svg_paths, out_path)
+                if best is None:
+                    best = stages
+                else:
+                    for stage in STAGES:
+                        best[stage][0] = min(best[stage][0], stages[stage][0])
+            tracemalloc.start()
+            try:
+                traced, _ = run_case(params, svg_paths, out_path, memory=True)
+            finally:
+                tracemalloc.stop()
+            result = {"case": name, "frames": len(svg_paths), "points": points, "stages": {}}
+            for stage in STAGES:
+                seconds = best[stage][0]
+                result["stages"][stage] = {
+                    "seconds": seconds,
+                    "points_per_second": points / seconds if seconds > 0 else None,
+                    "peak_bytes": traced[stage][1],
+                }
+            results.append(result)
+            sys.stderr.write("%-16s %8d points  %s\n"%(name, points, "  ".join(
+                "%s %.3fs"%(stage, best[stage][0]) for stage in STAGES)))
+    return results
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    # stage times of two reports, case by case
+    old = dict((r["case"], r) for r in old["results"])
+    for r in new["results"]:
+        o = old.get(r["case"])
+        if o is None:
+            continue
+        print("%-16s %s"%(r["case"], "  ".join(
+            "%s %.2fx"%(stage, o["stages"][stage]["seconds"] / r["stages"][stage]["seconds"])
+            for stage in STAGES if r["stages"][stage]["seconds"] > 0)))
+
+
+if __name__ == "__main__":
+    repeat = 3
+    scales = SCALES
+    output = None
+    params = RenderParameters()
+
+    args = sys.argv[1:]
+    if args[:1] == ["-compare"] and len(args) == 3:
+        # speedup of the second report over the first
+        with open(args[1]) as f, open(args[2]) as g:
+            compare(json.load(f), json.load(g))
+        sys.exit(0)
+    while args and args[0].startswith("-"):
+        opt = args.pop(0)
+        if opt == "-full":
+            scales = FULL_SCALES
+        elif opt == "-repeat":
+            repeat = int(args.pop(0))
+        elif opt == "-cfg":
+            params.load(args.pop(0))
+        elif opt == "-o":
+            output = args.pop(0)
+        else:
+            sys.exit("Unknown option: %s"%opt)
+
+    with tempfile.TemporaryDirectory() as svg_directory:
+        cases = write_cases(svg_directory, scales)
+        input_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input")
+        uncle = sorted(f for f in os.listdir(input_directory) if f.startswith("uncle") and f.endswith(".svg"))
+        cases.append(("uncle", [os.path.join(input_directory, f) for f in uncle]))
+        if args:
+            # only the named cases
+            cases = [case for case in cases if case[0] in args]
+        # keep stdout for the report
+        with contextlib.redirect_stdout(sys.stderr):
+            results = benchmark(params, cases, repeat)
+
+    report = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": params.settings(),
+        "repeat": repeat,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
@@ -0,0 +1,83 @@
+import copy
+import math
+
+# settings that are counted in samples and shrink as the frame gets coarser
+DWELLS = (
+    "start_dwell",
+    "curve_dwell",
+    "corner_dwell",
+    "end_dwell",
+    "switch_on_dwell",
+    "switch_off_dwell",
+    "closed_overdraw",
+    "closed_start_dwell",
+    "closed_end_dwell",
+)
+
+# coarsest detail a frame is reduced to, relative to the configured settings
+MAX_SCALE = 64.0
+
+
+def frame_budget(params):
+    # points per frame for the configured scan rate and frame rate (0 = off)
+    if params.fps <= 0:
+        return 0
+    return int(params.rate / params.fps)
+
+def scaled_params(params, scale):
+    # params with the galvo steps made scale times longer, the flatness bound
+    # (a squared distance) scale^2 times looser and every dwell scale times shorter
+    p = copy.copy(params)
+    p.on_speed = params.on_speed * scale
+    p.off_speed = params.off_speed * scale
+    p.flatness = params.flatness * scale**2
+    for name in DWELLS:
+        setattr(p, name, int(round(getattr(params, name) / scale)))
+    return p
+
+def frame_points(frame, params, start=None, exact=True):
+    # points the encoded frame will have: encode_frame turns the first lit
+    # sample into extra_first_dwell copies of it
+    n = frame.count_points(params, start, exact)
+    if frame.objects:
+        n += params.extra_first_dwell - 1
+    return n
+
+def bisect_scale(points, budget, lo, hi, steps):
+    # narrow [lo, hi] on a log scale, where points(hi) <= budget < points(lo)
+    for _ in range(steps):
+        scale = math.sqrt(lo * hi)
+        if points(scale) <= budget:
+            hi = scale
+        else:
+            lo = scale
+    return hi
+
+def fit_budget(frame, params, budget, start=None):
+    # find the finest scale >= 1 at which the frame fits into budget points.
+    # The estimate (LaserFrame.estimate_points) brackets the scale, then a few
+    # exact counts settle it. Returns (scale, scaled copy of params); the
+    # frame may still not fit at MAX_SCALE.
+    def estimate(scale):
+        return frame_points(frame, scaled_params(params, scale), start, False)
+    def count(scale):
+        return frame_points(frame, scaled_params(params, scale), start)
+
+    guess = 1.0
+    if estimate(1.0) > budget:
+        guess = MAX_SCALE
+        if estimate(MAX_SCALE) <= budget:
+            guess = bisect_scale(estimate, budget, 1.0, MAX_SCALE, 12)
+    # the estimate is within a few percent for most frames
+    lo, hi = max(guess / 1.25, 1.0), min(guess * 1.25, MAX_SCALE)
+    if lo == 1.0 and count(1.0) <= budget:
+        return 1.0, scaled_params(params, 1.0)
+    while count(hi) > budget:
+        if hi == MAX_SCALE:
+            return MAX_SCALE, scaled_params(params, MAX_SCALE)
+        lo, hi = hi, min(hi * 1.25, MAX_SCALE)
+    if count(lo) <= budget:
+        # the estimate was too pessimistic
+        lo = 1.0
+    scale = bisect_scale(count, budget, lo, hi, 8)
+    return scale, scaled_params(params, scale)
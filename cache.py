@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+# bump when the rendering or encoding changes the output for the same input
+CACHE_VERSION = b"msvg2ild-frame-2"
+
+
+def frame_key(svg_data, params, optimize=True, center=True):
+    # content hash of the SVG plus every setting that affects the encoded frame
+    h = hashlib.sha256(CACHE_VERSION)
+    h.update(repr(sorted(params.settings().items())).encode())
+    h.update(repr((optimize, center)).encode())
+    h.update(svg_data)
+    return h.hexdigest()
+
+
+class FrameCache(object):
+    # encoded frame payloads (point records without the section header) and
+    # their render stats, keyed by frame_key()
+    #
+    # Entries live in a small in-memory LRU, so identical frames in one run
+    # are only rendered once. With a directory they are also stored on disk,
+    # where the least recently used files are evicted beyond max_bytes.
+    def __init__(self, directory=None, max_bytes=1 << 30, memory_bytes=64 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            for entry in os.scandir(directory):
+                if entry.name.endswith(".frame"):
+                    self.size += entry.stat().st_size
+    def path(self, key):
+        return os.path.join(self.directory, key + ".frame")
+    def __contains__(self, key):
+        return key in self.memory or (self.directory is not None and os.path.exists(self.path(key)))
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return entry
+        if self.directory:
+            path = self.path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                pass
+            else:
+                # the mtime doubles as the last access time for eviction
+                os.utime(path)
+                header, payload = data.split(b"\n", 1)
+                entry = (payload, json.loads(header))
+                self.remember(key, entry)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        return None
+    def put(self, key, payload, stats):
+        payload = bytes(payload)
+        self.remember(key, (payload, stats))
+        if self.directory:
+            path = self.path(key)
+            if os.path.exists(path):
+                return
+            data = json.dumps(stats).encode() + b"\n" + payload
+            tmp = "%s.%d.tmp"%(path, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+    def remember(self, key, entry):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = entry
+        self.memory_size += len(entry[0])
+        while self.memory_size > self.memory_bytes and len(self.memory) > 1:
+            _, (payload, stats) = self.memory.popitem(last=False)
+            self.memory_size -= len(payload)
+    def evict(self):
+        # drop the least recently used files until the directory fits again
+        files = []
+        self.size = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".frame"):
+                st = entry.stat()
+                files.append((st.st_mtime, entry.path, st.st_size))
+                self.size += st.st_size
+        files.sort()
+        for mtime, path, size in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
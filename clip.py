@@ -0,0 +1,105 @@
+from path import PathLine, PathBezier3, PathBezier4, split_bezier
+
+# the projection area in normalised units
+WINDOW = (-1.0, -1.0, 1.0, 1.0)
+
+
+def bbox(points):
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def inside(box, window=WINDOW):
+    return box[0] >= window[0] and box[1] >= window[1] and box[2] <= window[2] and box[3] <= window[3]
+
+def overlaps(box, window=WINDOW):
+    return box[0] <= window[2] and box[1] <= window[3] and box[2] >= window[0] and box[3] >= window[1]
+
+def clip_line(start, end, window=WINDOW):
+    # Liang-Barsky: the part of start..end inside the window, or None
+    x0, y0 = start
+    dx = end[0] - x0
+    dy = end[1] - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - window[0]), (dx, window[2] - x0),
+                 (-dy, y0 - window[1]), (dy, window[3] - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+        if t0 > t1:
+            return None
+    if t0 == t1:
+        # only touches the window (a corner, or an edge end on)
+        return None
+    a = start if t0 == 0 else (x0 + t0*dx, y0 + t0*dy)
+    b = end if t1 == 1 else (x0 + t1*dx, y0 + t1*dy)
+    if a == b and (t0 > 0 or t1 < 1):
+        return None
+    return a, b
+
+def clip_segment(seg, step, window=WINDOW):
+    # pieces of a segment that lie inside the window, in order. Curves are
+    # split until each piece is inside, outside, or shorter than step; those
+    # last few are clipped as lines
+    if isinstance(seg, PathLine):
+        clipped = clip_line(seg.start, seg.end, window)
+        if clipped is None:
+            return []
+        if clipped == (seg.start, seg.end):
+            return [seg]
+        return [PathLine(clipped[0], clipped[1], seg.on)]
+    curve = seg.cubic() if isinstance(seg, PathBezier3) else seg
+    out = []
+    cut = False
+    stack = [(curve.start, curve.cp1, curve.cp2, curve.end)]
+    while stack:
+        curve = stack.pop()
+        box = bbox(curve)
+        if inside(box, window):
+            out.append(PathBezier4(*curve))
+        elif not overlaps(box, window):
+            cut = True
+        elif max(box[2] - box[0], box[3] - box[1]) <= step:
+            clipped = clip_line(curve[0], curve[3], window)
+            if clipped == (curve[0], curve[3]):
+                out.append(PathBezier4(*curve))
+                continue
+            if clipped is not None:
+                out.append(PathLine(clipped[0], clipped[1]))
+            cut = True
+        else:
+            first, second = split_bezier(*curve)
+            stack.append(second)
+            stack.append(first)
+    if not cut:
+        # only the control points stuck out
+        return [seg]
+    return out
+
+def clip_path(path, step, window=WINDOW):
+    # segment runs of a path that stay inside the window, one per visit, or
+    # None if nothing had to be cut
+    runs = []
+    run = []
+    cut = False
+    for seg in path.segments:
+        pieces = clip_segment(seg, step, window)
+        if pieces != [seg]:
+            cut = True
+        for piece in pieces:
+            if run and run[-1].end != piece.start:
+                runs.append(run)
+                run = []
+            run.append(piece)
+    if run:
+        runs.append(run)
+    if len(runs) > 1 and path.is_closed() and runs[-1][-1].end == runs[0][0].start:
+        # a closed path that was cut open: its last run continues into the first
+        runs[0] = runs.pop() + runs[0]
+    if not cut:
+        return None
+    return runs
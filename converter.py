@@ -0,0 +1,72 @@
+import copy
+import io
+import struct
+import time
+from cache import FrameCache, frame_key
+from ilda import ILDA_HEADER, ILDA_TOTAL_OFFSET
+from main import render_svg, encode_frame, frame_section, cached_stats
+from optimize import FrameChain
+from render_parameters import RenderParameters
+
+
+class Converter(object):
+    # in-memory SVG to ILDA conversion for embedding, e.g.
+    #
+    #   conv = Converter()
+    #   ild = conv.convert(svg_bytes)           # one frame
+    #   ild = conv.convert([svg1, svg2, ...])   # an animation
+    #
+    # SVGs are bytes or str. The frame cache, the path data cache and the
+    # SAX parser stay warm between calls, so converting the same or similar
+    # artwork again is cheap.
+    def __init__(self, params=None, optimize=True, center=True, cache=None):
+        self.params = params if params is not None else RenderParameters()
+        self.optimize = optimize
+        self.center = center
+        self.cache = cache if cache is not None else FrameCache()
+        # per-frame stats of the last convert() or stream()
+        self.stats = []
+    def convert_frame(self, svg, frame_index=0, total_frames=0, chain=None):
+        # one ILDA section (header + records) and the frame's stats
+        data = svg.encode() if isinstance(svg, str) else bytes(svg)
+        key = None
+        if chain is None:
+            key = frame_key(data, self.params, self.optimize, self.center)
+            entry = self.cache.get(key)
+            if entry is not None:
+                payload, stats = entry
+                return frame_section(payload, frame_index, total_frames), cached_stats(stats)
+        params = copy.copy(self.params)
+        rframe = render_svg(params, io.BytesIO(data), self.optimize, chain)
+        t = time.perf_counter()
+        section = encode_frame(params, rframe, frame_index, total_frames, self.center)
+        params.time_encode = time.perf_counter() - t
+        if key is not None:
+            self.cache.put(key, section[ILDA_HEADER.size:], params.stats())
+        return section, params.stats()
+    def stream(self, svgs):
+        # yields the sections and then the end of file header. The frame
+        # total is only known up front for sized inputs such as lists;
+        # otherwise it is left at 0
+        if isinstance(svgs, (bytes, bytearray, str)):
+            svgs = [svgs]
+        total = len(svgs) if hasattr(svgs, "__len__") else 0
+        chain = FrameChain() if self.params.coherent and self.optimize else None
+        self.stats = []
+        frame_index = 0
+        for svg in svgs:
+            section, stats = self.convert_frame(svg, frame_index, total, chain)
+            self.stats.append(stats)
+            frame_index += 1
+            yield bytes(section)
+        yield ILDA_HEADER.pack(b"ILDA", 0, b"svg2ilda", b"", 0, 0, total or frame_index, 0)
+    def convert(self, svgs):
+        # the complete ILDA file as bytes
+        sections = list(self.stream(svgs))
+        total = struct.pack(">H", len(sections) - 1)
+        out = bytearray(b"".join(sections))
+        offset = 0
+        for section in sections:
+            out[offset + ILDA_TOTAL_OFFSET:offset + ILDA_TOTAL_OFFSET + 2] = total
+            offset += len(section)
+        return bytes(out)
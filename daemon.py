@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, sys
+import copy
+import itertools
+import json
+import multiprocessing
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from converter import Converter
+from ilda import ILDA_HEADER
+from main import frame_error
+from render_parameters import RenderParameters
+
+# how many finished jobs /status reports
+HISTORY = 100
+# sections a job may have rendered ahead of its client
+SECTIONS_AHEAD = 8
+# frames of a job handed to the pool at a time, per worker process
+FRAMES_AHEAD = 2
+
+
+# worker processes keep one warm Converter each
+_converter = None
+
+def init_worker():
+    global _converter
+    _converter = Converter()
+
+def convert_frame(job):
+    params, data, frame_index, total_frames, optimize, center = job
+    _converter.params = params
+    _converter.optimize = optimize
+    _converter.center = center
+    try:
+        section, stats = _converter.convert_frame(data, frame_index, total_frames)
+    except Exception as e:
+        raise frame_error("frame %d"%frame_index, e) from None
+    return bytes(section), stats
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    # one conversion request; sections are handed to the request thread
+    # through out, followed by None (done) or an exception. out is bounded,
+    # so rendering waits for slow clients; a cancelled job (its client went
+    # away) stops at the next section
+    ids = itertools.count(1)
+    def __init__(self, params, svgs, optimize=True, center=True):
+        self.id = next(self.ids)
+        self.params = params
+        self.svgs = svgs
+        self.optimize = optimize
+        self.center = center
+        self.out = queue.Queue(SECTIONS_AHEAD)
+        self.cancelled = False
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.points = 0
+        self.cache_hits = 0
+        self.error = None
+    def info(self):
+        now = time.time()
+        return {
+            "id": self.id,
+            "frames": len(self.svgs),
+            "points": self.points,
+            "cache_hits": self.cache_hits,
+            "wait": (self.started or now) - self.queued,
+            "seconds": ((self.finished or now) - self.started) if self.started else None,
+            "error": self.error,
+            "cancelled": self.cancelled,
+        }
+    def put(self, item):
+        # hand item to the request thread, waiting while it is behind
+        while True:
+            if self.cancelled:
+                raise JobCancelled()
+            try:
+                self.out.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+
+class ConversionService(object):
+    # runs queued jobs one after another, spreading each job's frames over a
+    # pool of worker processes (frames of a coherent job render in order)
+    def __init__(self, params=None, jobs=1):
+        self.params = params if params is not None else RenderParameters()
+        self.processes = jobs
+        self.pool = multiprocessing.Pool(jobs, initializer=init_worker)
+        self.coherent = Converter()
+        self.jobs = queue.Queue()
+        self.running = None
+        self.history = deque(maxlen=HISTORY)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    def job_params(self, overrides):
+        # the service's parameters with per-job overrides of any setting
+        params = copy.copy(self.params)
+        settings = params.settings()
+        for name, value in overrides.items():
+            if name not in settings:
+                raise ValueError("Unknown parameter: %s"%name)
+            if isinstance(value, str) and not isinstance(settings[name], str):
+                # query parameters arrive as strings
+                value = json.loads(value)
+            setattr(params, name, value)
+        return params
+    def submit(self, job):
+        self.jobs.put(job)
+        return job
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            with self.lock:
+                self.running = job
+            job.started = time.time()
+            try:
+                if job.cancelled:
+                    raise JobCancelled()
+                for section, stats in self.frames(job):
+                    job.points += stats.get("points", 0)
+                    job.cache_hits += stats.get("cache_hit", 0)
+                    job.put(section)
+                total = len(job.svgs)
+                job.put(ILDA_HEADER.pack(b"ILDA", 0, b"svg2ilda", b"", 0, 0, total, 0))
+                job.put(None)
+            except JobCancelled:
+                job.error = "cancelled"
+            except Exception as e:
+                job.error = str(e)
+                try:
+                    job.put(e)
+                except JobCancelled:
+                    pass
+            job.finished = time.time()
+            with self.lock:
+                self.running = None
+                self.history.append(job)
+    def frames(self, job):
+        total = len(job.svgs)
+        if job.params.coherent and job.optimize:
+            conv = self.coherent
+            conv.params, conv.optimize, conv.center = job.params, job.optimize, job.center
+            stream = conv.stream(job.svgs)
+            for frame_index in range(total):
+                try:
+                    section = next(stream)
+                except Exception as e:
+                    raise frame_error("frame %d"%frame_index, e) from None
+                yield section, conv.stats[frame_index]
+            return
+        # frames go to the pool a few at a time, so a failed or cancelled job
+        # leaves at most that many behind instead of all of its frames
+        work = enumerate(job.svgs)
+        pending = deque()
+        while True:
+            for i, svg in itertools.islice(work, FRAMES_AHEAD * self.processes - len(pending)):
+                pending.append(self.pool.apply_async(convert_frame,
+                                                     ((job.params, svg, i, total, job.optimize, job.center),)))
+            if not pending:
+                return
+            yield pending.popleft().get()
+    def status(self):
+        with self.lock:
+            running = self.running.info() if self.running else None
+            history = [job.info() for job in self.history]
+        return {"queue": self.jobs.qsize(), "running": running, "jobs": history}
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST /convert with an SVG body (settings as query parameters), or a
+    # JSON body {"svgs": [...] or "directory": path, "params": {...},
+    # "optimize": bool, "center": bool}; the ILD file is streamed back.
+    # GET /status reports the queue depth and recent job timings.
+    protocol_version = "HTTP/1.1"
+    service = None
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else "local"
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_GET(self):
+        if urlsplit(self.path).path == "/status":
+            self.send_json(200, self.service.status())
+        else:
+            self.send_json(404, {"error": "not found"})
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/convert":
+            self.send_json(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            job = self.parse_job(body, dict(parse_qsl(url.query)))
+        except (ValueError, KeyError, OSError) as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        self.service.submit(job)
+        depth = self.service.jobs.qsize()
+        try:
+            self.stream(job, depth)
+        except (JobCancelled, OSError):
+            # the client went away: stop the job instead of rendering it for nobody
+            job.cancelled = True
+            self.close_connection = True
+    def stream(self, job, depth):
+        # hold the status line back until the first section, so a job that
+        # fails straight away can still be answered with an error
+        item = self.next_item(job)
+        if isinstance(item, Exception):
+            self.send_json(400 if isinstance(item, ValueError) else 500, {"error": str(item), "job": job.id})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("X-Job-Id", str(job.id))
+        self.send_header("X-Queue-Depth", str(depth))
+        self.end_headers()
+        while True:
+            if item is None:
+                self.wfile.write(b"0\r\n\r\n")
+                break
+            if isinstance(item, Exception):
+                # the status line is gone; cut the stream short instead
+                self.close_connection = True
+                break
+            self.wfile.write(b"%x\r\n"%len(item) + item + b"\r\n")
+            item = self.next_item(job)
+    def next_item(self, job):
+        # the job's next section, watching the connection while it renders
+        # (or waits in the queue)
+        while True:
+            try:
+                return job.out.get(timeout=0.5)
+            except queue.Empty:
+                if self.disconnected():
+                    raise JobCancelled()
+    def disconnected(self):
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.connection.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+    def parse_job(self, body, query):
+        optimize = query.pop("optimize", "1") not in ("0", "false")
+        center = query.pop("center", "1") not in ("0", "false")
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            request = json.loads(body)
+            optimize = request.get("optimize", optimize)
+            center = request.get("center", center)
+            query.update(request.get("params", {}))
+            if "directory" in request:
+                directory = request["directory"]
+                svgs = []
+                for f in sorted(os.listdir(directory)):
+                    if f.endswith(".svg"):
+                        with open(os.path.join(directory, f), "rb") as fin:
+                            svgs.append(fin.read())
+            else:
+                svgs = [svg.encode() for svg in request["svgs"]]
+        else:
+            svgs = [body]
+        if not svgs:
+            raise ValueError("No SVG files")
+        return Job(self.service.job_params(query), svgs, optimize, center)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    jobs = 1
+    host, port = "127.0.0.1", 8642
+    socket_path = None
+    params = RenderParameters()
+
+    args = sys.argv[1:]
+    while args and args[0].startswith("-"):
+        opt = args.pop(0)
+        if opt == "-cfg":
+            params.load(args.pop(0))
+        elif opt == "-j":
+            jobs = int(args.pop(0)) or os.cpu_count()
+        elif opt == "-port":
+            port = int(args.pop(0))
+        elif opt == "-socket":
+            socket_path = args.pop(0)
+        else:
+            sys.exit("Unknown option: %s"%opt)
+
+    Handler.service = ConversionService(params, jobs)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+        print("Listening on %s"%socket_path)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        print("Listening on http://%s:%d"%(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        Handler.service.close()
@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os, sys
+import mmap
+import struct
+
+ILDA_HEADER = struct.Struct(">4s3xB8s8sHHHBx")
+ILDA_POINT = struct.Struct(">hhBB")
+# bytes per point record for each ILDA format code
+ILDA_RECORD_SIZE = {0: 8, 1: 6, 2: 3, 4: 10, 5: 8}
+# offsets of the frame number and total frames fields inside a section header
+ILDA_INDEX_OFFSET = 26
+ILDA_TOTAL_OFFSET = 28
+# record layouts, for unpacking points
+ILDA_RECORD = {0: ">hhhBB", 1: ">hhBB", 2: ">BBB", 4: ">hhhBBBB", 5: ">hhBBBB"}
+
+
+def patch_total_frames(fout, total_frames):
+    # walk the section headers and fill in the final frame count
+    total = struct.pack(">H", total_frames)
+    offset = 0
+    while True:
+        fout.seek(offset)
+        hdr = fout.read(ILDA_HEADER.size)
+        if len(hdr) < ILDA_HEADER.size:
+            break
+        magic, fmt, name, company, samples, frame_index, _, projector = ILDA_HEADER.unpack(hdr)
+        if magic != b"ILDA":
+            raise ValueError("Bad ILDA header at offset %d"%offset)
+        fout.seek(offset + ILDA_TOTAL_OFFSET)
+        fout.write(total)
+        offset += ILDA_HEADER.size + samples * ILDA_RECORD_SIZE[fmt]
+    fout.seek(0, os.SEEK_END)
+
+
+class ILDAFile(object):
+    # memory-mapped ILDA file with an index of its sections
+    #
+    # frames holds (offset, format, samples) per section up to the end of
+    # file header; records(i) is a zero-copy view of a section's point
+    # records. With writable=True, append() adds sections in place.
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            open(path, "wb").close()
+        self.file = open(path, "r+b" if writable else "rb")
+        self.map = None
+        self.frames = []
+        # offset of the end of file header, or of the end of the data
+        self.end = 0
+        self.index()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+    def __len__(self):
+        return len(self.frames)
+    def index(self):
+        # one pass over the section headers
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.frames = []
+        self.end = 0
+        size = os.fstat(self.file.fileno()).st_size
+        if size == 0:
+            return
+        access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+        self.map = mmap.mmap(self.file.fileno(), 0, access=access)
+        offset = 0
+        while offset + ILDA_HEADER.size <= size:
+            magic, fmt, name, company, samples, frame_index, total, projector = ILDA_HEADER.unpack_from(self.map, offset)
+            if magic != b"ILDA":
+                raise ValueError("Bad ILDA header at offset %d"%offset)
+            if fmt not in ILDA_RECORD_SIZE:
+                raise ValueError("Unknown ILDA format %d at offset %d"%(fmt, offset))
+            if samples == 0:
+                break
+            length = samples * ILDA_RECORD_SIZE[fmt]
+            if offset + ILDA_HEADER.size + length > size:
+                raise ValueError("Truncated ILDA section at offset %d"%offset)
+            self.frames.append((offset, fmt, samples))
+            offset += ILDA_HEADER.size + length
+        self.end = offset
+    def header(self, i):
+        return ILDA_HEADER.unpack_from(self.map, self.frames[i][0])
+    def records(self, i):
+        offset, fmt, samples = self.frames[i]
+        start = offset + ILDA_HEADER.size
+        return memoryview(self.map)[start:start + samples * ILDA_RECORD_SIZE[fmt]]
+    def points(self, i):
+        # unpacked point records of section i
+        return struct.iter_unpack(ILDA_RECORD[self.frames[i][1]], self.records(i))
+    def append(self, sections):
+        # add encoded sections (header + records) after the last one, then
+        # rewrite the end of file header and the frame number and total
+        # fields; the existing point records are left alone
+        if not self.writable:
+            raise ValueError("%s is not open for writing"%self.path)
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        first = len(self.frames)
+        offsets = [offset for offset, fmt, samples in self.frames]
+        self.file.seek(self.end)
+        self.file.truncate()
+        for n, data in enumerate(sections):
+            offsets.append(self.file.tell())
+            self.file.write(data)
+            self.file.seek(offsets[-1] + ILDA_INDEX_OFFSET)
+            self.file.write(struct.pack(">H", first + n))
+            self.file.seek(0, os.SEEK_END)
+        total = len(offsets)
+        offsets.append(self.file.tell())
+        self.file.write(ILDA_HEADER.pack(b"ILDA", 0, b"svg2ilda", b"", 0, 0, total, 0))
+        for offset in offsets:
+            self.file.seek(offset + ILDA_TOTAL_OFFSET)
+            self.file.write(struct.pack(">H", total))
+        self.file.flush()
+        self.index()
+        return total - first
+
+
+def first_difference(a, b, i):
+    for k, (pa, pb) in enumerate(zip(a.points(i), b.points(i))):
+        if pa != pb:
+            return k
+
+def compare(path_a, path_b):
+    # frame-by-frame comparison of two ILDA files: a list of
+    # (frame number, reason) for every frame that differs
+    diffs = []
+    with ILDAFile(path_a) as a, ILDAFile(path_b) as b:
+        for i in range(max(len(a), len(b))):
+            if i >= len(a) or i >= len(b):
+                diffs.append((i, "missing in %s"%(path_a if i >= len(a) else path_b)))
+                continue
+            fa, fb = a.frames[i], b.frames[i]
+            if fa[1] != fb[1]:
+                diffs.append((i, "format %d != %d"%(fa[1], fb[1])))
+            elif fa[2] != fb[2]:
+                diffs.append((i, "%d != %d points"%(fa[2], fb[2])))
+            elif a.records(i) != b.records(i):
+                diffs.append((i, "point %d differs"%first_difference(a, b, i)))
+    return diffs
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["info"] and len(args) == 2:
+        with ILDAFile(args[1]) as f:
+            print("%d frames, %d points"%(len(f), sum(samples for _, _, samples in f.frames)))
+    elif args[:1] == ["compare"] and len(args) == 3:
+        diffs = compare(args[1], args[2])
+        for i, reason in diffs:
+            print("frame %d: %s"%(i, reason))
+        if diffs:
+            sys.exit(1)
+        print("identical")
+    elif args[:1] == ["append"] and len(args) >= 3:
+        with ILDAFile(args[1], writable=True) as out:
+            for path in args[2:]:
+                with ILDAFile(path) as f:
+                    sections = [f.map[offset:offset + ILDA_HEADER.size + samples * ILDA_RECORD_SIZE[fmt]]
+                                for offset, fmt, samples in f.frames]
+                out.append(sections)
+            print("%d frames"%len(out))
+    else:
+        sys.exit("Usage: ilda.py info FILE | compare A B | append OUT IN...")
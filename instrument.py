@@ -0,0 +1,64 @@
+import cProfile
+import csv
+import io
+import json
+import pstats
+import time
+import tracemalloc
+
+
+class StatsWriter(object):
+    # per-frame stats as JSON lines, or CSV if the file name ends in .csv
+    def __init__(self, path, names):
+        self.file = open(path, "w", newline="")
+        self.names = ["frame", "file"] + list(names)
+        self.csv = None
+        if path.endswith(".csv"):
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(self.names)
+    def write(self, frame_index, name, stats):
+        row = [frame_index, name] + [stats.get(n, 0) for n in self.names[2:]]
+        if self.csv is not None:
+            self.csv.writerow(row)
+        else:
+            self.file.write(json.dumps(dict(zip(self.names, row))) + "\n")
+    def close(self):
+        self.file.close()
+
+
+class FrameProfiler(object):
+    # runs each frame under cProfile (and tracemalloc, with memory=True)
+    # and keeps the profile of the slowest ones
+    def __init__(self, keep=5, memory=False):
+        self.keep = keep
+        self.memory = memory
+        # (seconds, svg path, pstats.Stats, peak bytes), slowest first
+        self.frames = []
+    def run(self, func, job):
+        # job is a main.convert_svg job; its second item is the SVG path
+        profile = cProfile.Profile()
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = profile.runcall(func, job)
+        finally:
+            seconds = time.perf_counter() - start
+            peak = None
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        self.frames.append((seconds, job[1], pstats.Stats(profile), peak))
+        self.frames.sort(key=lambda f: -f[0])
+        del self.frames[self.keep:]
+        return result
+    def report(self, functions=10):
+        out = io.StringIO()
+        for seconds, svg_path, stats, peak in self.frames:
+            out.write("%s: %.3fs"%(svg_path, seconds))
+            if peak is not None:
+                out.write(", peak memory %.1f MB"%(peak / float(1 << 20)))
+            out.write("\n")
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(functions)
+        return out.getvalue()
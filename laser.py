@@ -1,5 +1,10 @@
+import copy
 import math
-from path import PathLine
+from array import array
+from path import PathLine, simplify_polyline
+from spatial import PointTree
+from optimize import refine_order, coherent_order
+from clip import bbox, inside, overlaps, clip_path
 
 
 class LaserFrame(object):
@@ -10,50 +15,207 @@ class LaserFrame(object):
     def transform(self, func):
         for i in self.objects:
             i.transform(func)
-    def render(self, params):
+    def render(self, params, out=None, start=None):
+        if out is None:
+            out = SampleBuffer()
         if not self.objects:
-            return []
-        out = []
+            return out
+        first = len(out)
+        if start is not None:
+            # open frame: travel in from where the previous frame left the
+            # beam, and stop after the last object instead of returning
+            npos = self.objects[0].startpos()
+            PathLine(start,npos,False).render(params, out)
+            out.dwell(int(npos[0]*params.width), int(npos[1]*params.height), params.switch_off_dwell, False)
+            params.points_dwell_switch += params.switch_off_dwell
         for n,i in enumerate(self.objects):
             params.objects += 1
-            out += i.render(params)
-            cpos = out[-1].coord[0] / params.width, out[-1].coord[1] / params.height
+            i.render(params, out)
+            cpos = out.x[-1] / params.width, out.y[-1] / params.height
+            out.dwell(int(cpos[0]*params.width), int(cpos[1]*params.height), params.switch_on_dwell, False)
+            params.points_dwell_switch += params.switch_on_dwell
+            if start is not None and n == len(self.objects) - 1:
+                break
             npos = self.objects[(n+1) % len(self.objects)].startpos()
-            trip = [LaserSample((int(cpos[0]*params.width),int(cpos[1]*params.height)))] * params.switch_on_dwell
-            trip += PathLine(cpos,npos,False).render(params)
-            trip += [LaserSample((int(npos[0]*params.width),int(npos[1]*params.height)))] * params.switch_off_dwell
-            params.points_dwell_switch += params.switch_on_dwell + params.switch_off_dwell
-            for s in trip:
-                s.on = False
-            out += trip
-        params.points = len(out)
-        params.points_on = sum([int(s.on) for s in out])
+            PathLine(cpos,npos,False).render(params, out)
+            out.dwell(int(npos[0]*params.width), int(npos[1]*params.height), params.switch_off_dwell, False)
+            params.points_dwell_switch += params.switch_off_dwell
+        params.points = len(out) - first
+        params.points_on = out.on.count(1, first)
         return out
-    def sort(self):
+    def count_points(self, params, start=None, exact=True):
+        # number of samples render() emits, without emitting them. With
+        # exact=False, Bezier curves are estimated instead of subdivided and
+        # blank moves are measured from each path's end point instead of its
+        # last rendered sample (see estimate_points)
+        n = 0
+        for i in self.objects:
+            n += i.count_points(params, exact) + params.switch_on_dwell
+        moves = [PathLine(a, b, False) for a, b in self.moves(start, params if exact else None)]
+        n += sum(m.count_points(params) for m in moves)
+        n += params.switch_off_dwell * len(moves)
+        return n
+    def moves(self, start=None, params=None):
+        # (from, to) of every blank move render() makes, in order. render()
+        # starts each move at the last sample of the path before it, which
+        # is rounded to the output grid (and, after a closed overdraw, is
+        # not the path's end point at all); with params the moves start
+        # there too, otherwise at the paths' exact end points
+        objects = self.objects
+        if not objects:
+            return []
+        if params is not None:
+            w, h = params.width, params.height
+            ends = [(x / w, y / h) for x, y in (o.last_sample(params) for o in objects)]
+        else:
+            ends = [o.endpos() for o in objects]
+        if start is not None:
+            moves = [(start, objects[0].startpos())]
+            moves += [(ends[n], objects[n+1].startpos()) for n in range(len(objects) - 1)]
+        else:
+            moves = [(ends[n], objects[(n+1) % len(objects)].startpos()) for n in range(len(objects))]
+        return moves
+    def estimate_points(self, params, start=None):
+        # fast approximation of count_points(): lines, blank moves and dwells
+        # are counted exactly, each Bezier curve is estimated from its control
+        # points (path.estimate_bezier) in constant time. The curve estimate
+        # is exact for curves of even speed and bend and within a factor of
+        # about 1.6 for any single curve; summed over a frame it came within
+        # 8% of the real count on the example frames and on random curves,
+        # for on_speed/flatness from 1/4 to 16 times the defaults.
+        return self.count_points(params, start, exact=False)
+    def sort(self, rotate_closed=False, start=(0,0)):
+        # greedy nearest neighbour ordering; each step picks the closest
+        # start or end point, with ties going to the earliest object.
+        # with rotate_closed, closed paths may be entered at any vertex.
+        points = []
+        for i,o in enumerate(self.objects):
+            if rotate_closed and o.is_closed():
+                for k,seg in enumerate(o.segments):
+                    points.append((seg.start, (i,k)))
+            else:
+                points.append((o.startpos(), (i,0)))
+                points.append((o.endpos(), (i,1)))
+        tree = PointTree(points)
         oobj = []
-        cx,cy = 0,0
-        while self.objects:
-            best = 99999
-            besti = 0
-            bestr = False
-            for i,o in enumerate(self.objects):
-                x,y = o.startpos()
-                d = (x-cx)**2 + (y-cy)**2
-                if d < best:
-                    best = d
-                    besti = i
-                x,y = o.endpos()
-                d = (x-cx)**2 + (y-cy)**2
-                if d < best:
-                    best = d
-                    besti = i
-                    bestr = True
-            obj = self.objects.pop(besti)
-            if bestr:
-                obj = obj.reverse()
+        cx,cy = start
+        while tree:
+            d, (i, slot) = tree.nearest((cx,cy))
+            obj = self.objects[i]
+            if rotate_closed and obj.is_closed():
+                for k in range(len(obj.segments)):
+                    tree.remove((i,k))
+                if slot:
+                    obj = obj.rotate(slot)
+            else:
+                tree.remove((i,0))
+                tree.remove((i,1))
+                if slot:
+                    obj = obj.reverse()
             oobj.append(obj)
             cx,cy = obj.endpos()
         self.objects = oobj
+    def reorder(self, hint, start, rotate_closed=False, tolerance=0.05):
+        # follow the order of a previous, similar frame (see optimize.order_hint)
+        objects = coherent_order(self.objects, hint, start, rotate_closed, tolerance)
+        if objects is None:
+            self.sort(rotate_closed, start)
+        else:
+            self.objects = objects
+    def simplify(self, params):
+        # merge near-collinear runs of lines in every path (see LaserPath.simplify)
+        if params.simplify <= 0:
+            return
+        for i in self.objects:
+            before = len(i.segments), i.count_points(params, False)
+            i.simplify(params.simplify)
+            params.simplify_segments += before[0] - len(i.segments)
+            params.simplify_points += before[1] - i.count_points(params, False)
+    def cull(self, params):
+        # drop paths smaller than min_size, and with clip, drop the paths
+        # outside the projection area and cut the ones crossing its edge
+        if params.min_size <= 0 and not params.clip:
+            return
+        oobj = []
+        for o in self.objects:
+            box = o.bbox()
+            if max(box[2] - box[0], box[3] - box[1]) < params.min_size:
+                params.culled_small += 1
+                continue
+            if not params.clip or inside(box):
+                oobj.append(o)
+                continue
+            if not overlaps(box):
+                params.culled_paths += 1
+                continue
+            runs = clip_path(o, params.on_speed)
+            if runs is None:
+                oobj.append(o)
+                continue
+            if not runs:
+                params.culled_paths += 1
+                continue
+            params.clipped_paths += 1
+            for run in runs:
+                path = LaserPath()
+                path.segments = run
+                oobj.append(path)
+        self.objects = oobj
+    def merge(self, params):
+        # join open paths whose ends meet (within merge_tolerance) into one
+        # continuous path, reversing them where needed, so the beam does not
+        # blank and dwell between them
+        if not params.merge:
+            return
+        tol2 = params.merge_tolerance**2
+        points = []
+        for i,o in enumerate(self.objects):
+            if not o.is_closed():
+                points.append((o.startpos(), (i,0)))
+                points.append((o.endpos(), (i,1)))
+        tree = PointTree(points)
+        def take(pos):
+            found = tree.nearest(pos)
+            if found is None or found[0] > tol2:
+                return None
+            i, slot = found[1]
+            tree.remove((i,0))
+            tree.remove((i,1))
+            return self.objects[i], slot
+        oobj = []
+        for i,o in enumerate(self.objects):
+            if o.is_closed():
+                oobj.append(o)
+                continue
+            if (i,0) not in tree.points:
+                continue
+            tree.remove((i,0))
+            tree.remove((i,1))
+            segments = list(o.segments)
+            while True:
+                found = take(segments[-1].end)
+                if found is None:
+                    break
+                p, slot = found
+                p = p.reverse() if slot else p.copy()
+                p.segments[0].start = segments[-1].end
+                segments += p.segments
+                params.merged_paths += 1
+            while True:
+                found = take(segments[0].start)
+                if found is None:
+                    break
+                p, slot = found
+                p = p.copy() if slot else p.reverse()
+                p.segments[-1].end = segments[0].start
+                segments = p.segments + segments
+                params.merged_paths += 1
+            path = LaserPath()
+            path.segments = segments
+            oobj.append(path)
+        self.objects = oobj
+    def refine(self, params, start=None):
+        self.objects = refine_order(self.objects, params, start)
     def showinfo(self, tr=''):
         print(tr+'LaserFrame:')
         for i in self.objects:
@@ -68,68 +230,180 @@ class LaserSample(object):
     def __repr__(self):
         return "LaserSample((%d,%d),%r)"%(self.coord[0],self.coord[1],self.on)
 
+class SampleBuffer(object):
+    # rendered samples as parallel x/y arrays plus a blanking bitmap
+    #
+    # Render methods append to a shared buffer instead of building lists of
+    # LaserSample objects; indexing or iterating still yields LaserSamples.
+    def __init__(self):
+        self.x = array('i')
+        self.y = array('i')
+        self.on = bytearray()
+    @classmethod
+    def from_samples(cls, samples):
+        buf = cls()
+        for s in samples:
+            buf.append(s.coord[0], s.coord[1], s.on)
+        return buf
+    def __len__(self):
+        return len(self.on)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        return LaserSample((self.x[i], self.y[i]), bool(self.on[i]))
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def append(self, x, y, on=True):
+        self.x.append(x)
+        self.y.append(y)
+        self.on.append(on)
+    def extend(self, xs, ys, on=True):
+        self.x.extend(xs)
+        self.y.extend(ys)
+        self.on.extend(bytes([on]) * len(xs))
+    def dwell(self, x, y, n, on=True):
+        if n > 0:
+            self.x.extend(array('i', [x]) * n)
+            self.y.extend(array('i', [y]) * n)
+            self.on.extend(bytes([on]) * n)
+    def repeat(self, start, stop):
+        # append a copy of samples start..stop of this buffer
+        stop = min(stop, len(self))
+        self.x.extend(self.x[start:stop])
+        self.y.extend(self.y[start:stop])
+        self.on.extend(self.on[start:stop])
+
 class LaserPath(object):
     def __init__(self):
         self.segments = []
     def add(self, seg):
         self.segments.append(seg)
+    def copy(self):
+        lp = LaserPath()
+        lp.segments = [x.copy() for x in self.segments]
+        return lp
     def transform(self, func):
         for i in self.segments:
             i.transform(func)
-    def render(self, params):
-        is_closed = self.segments[0].start == self.segments[-1].end
+    def affine(self, m):
+        for i in self.segments:
+            i.affine(m)
+    def render(self, params, out=None):
+        if out is None:
+            out = SampleBuffer()
+        first = len(out)
+        w, h = params.width, params.height
+        is_closed = self.is_closed()
         sx,sy = self.segments[0].start
-        out = []
         if is_closed:
-            out += [LaserSample((int(sx*params.width),int(sy*params.height)))] * params.closed_start_dwell
+            out.dwell(int(sx*w), int(sy*h), params.closed_start_dwell)
         else:
-            out += [LaserSample((int(sx*params.width),int(sy*params.height)))] * params.start_dwell
+            out.dwell(int(sx*w), int(sy*h), params.start_dwell)
         params.points_dwell_start += params.start_dwell
         for i,s in enumerate(self.segments):
             params.subpaths += 1
-            out += s.render(params)
+            s.render(params, out)
             ex,ey = s.end
-            end_render = [LaserSample((int(ex*params.width),int(ey*params.height)))]
+            end_x, end_y = int(ex*w), int(ey*h)
             if i != len(self.segments)-1:
-                ecx,ecy = s.ecp()
-                sx,sy = self.segments[i+1].start
-                scx,scy = self.segments[i+1].scp()
-
-                dex,dey = ecx-ex,ecy-ey
-                dsx,dsy = sx-scx,sy-scy
-
-                dot = dex*dsx + dey*dsy
-                lens = math.sqrt(dex**2 + dey**2) * math.sqrt(dsx**2 + dsy**2)
-                if lens == 0:
-                    # bail
-                    out += end_render * params.corner_dwell
-                    params.points_dwell_corner += params.corner_dwell
+                if self.is_curve(i, params):
+                    out.dwell(end_x, end_y, params.curve_dwell)
+                    params.points_dwell_curve += params.curve_dwell
                 else:
-                    dot /= lens
-                    curve_angle = math.cos(params.curve_angle*(math.pi/180.0))
-                    if dot > curve_angle:
-                        out += end_render * params.curve_dwell
-                        params.points_dwell_curve += params.curve_dwell
-                    else:
-                        out += end_render * params.corner_dwell
-                        params.points_dwell_corner += params.corner_dwell
+                    out.dwell(end_x, end_y, params.corner_dwell)
+                    params.points_dwell_corner += params.corner_dwell
             elif is_closed:
-                overdraw = out[:params.closed_overdraw]
-                out += overdraw
-                out += [out[-1]] * params.closed_end_dwell
+                out.repeat(first, first + params.closed_overdraw)
+                out.dwell(out.x[-1], out.y[-1], params.closed_end_dwell, out.on[-1])
                 params.points_dwell_end += params.closed_end_dwell
             else:
-                out += end_render * params.end_dwell
+                out.dwell(end_x, end_y, params.end_dwell)
                 params.points_dwell_end += params.end_dwell
         return out
+    def is_curve(self, i, params):
+        # whether the node after segment i is smooth (curve_dwell) or a corner
+        s = self.segments[i]
+        ex,ey = s.end
+        ecx,ecy = s.ecp()
+        sx,sy = self.segments[i+1].start
+        scx,scy = self.segments[i+1].scp()
+
+        dex,dey = ecx-ex,ecy-ey
+        dsx,dsy = sx-scx,sy-scy
+
+        dot = dex*dsx + dey*dsy
+        lens = math.sqrt(dex**2 + dey**2) * math.sqrt(dsx**2 + dsy**2)
+        if lens == 0:
+            # bail
+            return False
+        dot /= lens
+        return dot > math.cos(params.curve_angle*(math.pi/180.0))
+    def count_points(self, params, exact=True):
+        # number of samples render() emits, without emitting them
+        is_closed = self.is_closed()
+        n = params.closed_start_dwell if is_closed else params.start_dwell
+        for i,s in enumerate(self.segments):
+            n += s.count_points(params, exact)
+            if i != len(self.segments)-1:
+                n += params.curve_dwell if self.is_curve(i, params) else params.corner_dwell
+        if is_closed:
+            n += min(params.closed_overdraw, n) + params.closed_end_dwell
+        else:
+            n += params.end_dwell
+        return n
+    def last_sample(self, params):
+        # the last sample render() emits, without rendering if possible
+        w, h = params.width, params.height
+        if self.is_closed():
+            if params.closed_overdraw > params.closed_start_dwell:
+                # a repeat of a sample inside the path
+                out = self.render(copy.copy(params))
+                return out.x[-1], out.y[-1]
+            if params.closed_overdraw:
+                # a repeat of the start dwell
+                sx,sy = self.segments[0].start
+                return int(sx*w), int(sy*h)
+        elif params.end_dwell:
+            ex,ey = self.segments[-1].end
+            return int(ex*w), int(ey*h)
+        return self.segments[-1].last_sample(params)
+    def bbox(self):
+        # (min x, min y, max x, max y) of all end and control points, which
+        # contains the path
+        return bbox([p for s in self.segments for p in s.points()])
+    def simplify(self, tolerance):
+        # replace every run of consecutive lines by the fewest lines that stay
+        # within tolerance (normalised units) of the original vertices
+        segments = []
+        run = []
+        for s in self.segments + [None]:
+            if isinstance(s, PathLine) and s.on:
+                run.append(s)
+                continue
+            if run:
+                points = [run[0].start] + [l.end for l in run]
+                keep = simplify_polyline(points, tolerance)
+                segments += [PathLine(points[a], points[b]) for a, b in zip(keep, keep[1:])]
+                run = []
+            if s is not None:
+                segments.append(s)
+        self.segments = segments
     def startpos(self):
         return self.segments[0].start
     def endpos(self):
         return self.segments[-1].end
+    def is_closed(self):
+        return self.segments[0].start == self.segments[-1].end
     def reverse(self):
         lp = LaserPath()
         lp.segments = [x.reverse() for x in self.segments[::-1]]
         return lp
+    def rotate(self, k):
+        # closed paths only: start at the beginning of segment k
+        lp = LaserPath()
+        lp.segments = self.segments[k:] + self.segments[:k]
+        return lp
     def showinfo(self, tr=''):
         print(tr+'LaserPath:')
         for i in self.segments:
@@ -2,10 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import os, sys
-import struct
+import copy
+import functools
+import multiprocessing
+import threading
+import time
 import xml.sax, xml.sax.handler
+from array import array
+from budget import fit_budget, frame_budget
+from cache import FrameCache, frame_key
+from ilda import ILDA_HEADER, ILDA_POINT, patch_total_frames
+from instrument import FrameProfiler, StatsWriter
+from laser import SampleBuffer
+from optimize import FrameChain, order_hint
 from render_parameters import RenderParameters
-from svg import SVGReader
+from svg import SVGReader, path_cache
 
 
 def pc(c):
@@ -15,136 +26,467 @@ def pc(c):
     else:
         return "(%.4f, %.4f)"%(x,y)
 
+_local = threading.local()
+
 def load_svg(path):
+    # path may also be a file object. The SAX parser is reused for every
+    # file parsed by this thread, unless a file fails to parse
     handler = SVGReader()
-    parser = xml.sax.make_parser()
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = xml.sax.make_parser()
+        parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    _local.parser = None
     parser.setContentHandler(handler)
-    parser.setFeature(xml.sax.handler.feature_external_ges, False)
     parser.parse(path)
+    _local.parser = parser
     return handler.frame
 
+def encode_frame(params, rframe, frame_index, total_frames, center=True):
+    # pack one ILDA format 1 section (header + point records) into a single buffer
+    if len(rframe) == 0:
+        raise ValueError("No points rendered")
+
+    if not isinstance(rframe, SampleBuffer):
+        rframe = SampleBuffer.from_samples(rframe)
+    xs = rframe.x.tolist()
+    ys = rframe.y.tolist()
+    min_x, max_x = min(xs), max(xs)
+    min_y, max_y = min(ys), max(ys)
+    ons = [bool(on) for on in rframe.on]
+
+    for i, on in enumerate(ons):
+        if on:
+            dwell = params.extra_first_dwell
+            xs[i:i+1] = [xs[i]] * dwell
+            ys[i:i+1] = [ys[i]] * dwell
+            ons[i:i+1] = [True] * dwell
+            break
+
+    if len(xs) == 0:
+        raise ValueError("No points rendered")
+
+    if center:
+        offx = -(min_x + max_x)/2
+        offy = -(min_y + max_y)/2
+        width = max_x - min_x
+        height = max_y - min_y
+    else:
+        offx = 0
+        offy = 0
+        width = 2*max(abs(min_x), abs(max_x))
+        height = 2*max(abs(min_y), abs(max_y))
+
+    scale = 1
+
+    if width > 65534 or height > 65534:
+        smax = max(width, height)
+        scale = 65534.0/smax
+        print("Scaling to %.02f%% due to overflow"%(scale*100))
+
+    samples = len(xs)
+    if samples >= 65535:
+        raise ValueError("Too many points (%d, max 65535)"%samples)
+
+    xs = [int((x + offx) * scale) for x in xs]
+    ys = [int((y + offy) * scale) for y in ys]
+    for axis, values in (("X", xs), ("Y", ys)):
+        if max(values) > 32767 or min(values) < -32767:
+            bad = next(v for v in values if abs(v) > 32767)
+            raise ValueError("%s out of bounds: %d"%(axis, bad))
+
+    if params.invert:
+        ons = [not on for on in ons]
+    if params.force:
+        ons = [True] * samples
+
+    # the records are interleaved column by column, so no struct format
+    # has to be built (and cached) for each frame length
+    xb = array('h', xs)
+    yb = array('h', [-y for y in ys])
+    if sys.byteorder == "little":
+        xb.byteswap()
+        yb.byteswap()
+    xb = xb.tobytes()
+    yb = yb.tobytes()
+    status = bytearray(0x00 if on else 0x40 for on in ons)
+    status[-1] |= 0x80
+
+    buf = bytearray(ILDA_HEADER.size + ILDA_POINT.size * samples)
+    ILDA_HEADER.pack_into(buf, 0, b"ILDA", 1, b"svg2ilda", b"", samples, frame_index, total_frames, 0)
+    off = ILDA_HEADER.size
+    step = ILDA_POINT.size
+    buf[off::step] = xb[0::2]
+    buf[off+1::step] = xb[1::2]
+    buf[off+2::step] = yb[0::2]
+    buf[off+3::step] = yb[1::2]
+    buf[off+4::step] = status
+    buf[off+5::step] = bytes(0x01 if on else 0x00 for on in ons)
+    return buf
+
+def frame_section(payload, frame_index, total_frames):
+    # re-attach a section header to cached point records
+    samples = len(payload) // ILDA_POINT.size
+    return ILDA_HEADER.pack(b"ILDA", 1, b"svg2ilda", b"", samples, frame_index, total_frames, 0) + payload
+
+def cached_stats(stats):
+    # stats of a frame served from the frame cache. The timings and path
+    # data cache counts belong to the run that rendered it, not to this one
+    return dict(stats, cache_hit=1, time_parse=0.0, time_sort=0.0, time_render=0.0, time_encode=0.0,
+                parse_cache_hits=0, parse_cache_misses=0)
+
+def write_ild_sections(sections, path):
+    # write encoded frames as they arrive, then patch the frame count. The
+    # file is written next to path and only replaces it once complete, so a
+    # failing frame leaves the previous output alone
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w+b") as fout:
+            total_frames = 0
+            for data in sections:
+                fout.write(data)
+                total_frames += 1
+            fout.write(ILDA_HEADER.pack(b"ILDA", 0, b"svg2ilda", b"", 0, 0, total_frames, 0))
+            patch_total_frames(fout, total_frames)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return total_frames
+
 def write_ild(params, rframes, path, center=True):
-    fout = open(path, "wb")
-    total_frames = len(rframes)
-    
-    for frame_index, rframe in enumerate(rframes):
-        min_x = min_y = max_x = max_y = None
-        for i, sample in enumerate(rframe):
-            x, y = sample.coord
-            if min_x is None or min_x > x:
-                min_x = x
-            if min_y is None or min_y > y:
-                min_y = y
-            if max_x is None or max_x < x:
-                max_x = x
-            if max_y is None or max_y < y:
-                max_y = y
-
-        for i, sample in enumerate(rframe):
-            if sample.on:
-                rframe = rframe[:i] + [sample]*params.extra_first_dwell + rframe[i+1:]
-                break
-
-        if len(rframe) == 0:
-            raise ValueError("No points rendered")
-
-        if center:
-            offx = -(min_x + max_x)/2
-            offy = -(min_y + max_y)/2
-            width = max_x - min_x
-            height = max_y - min_y
+    # rframes may be any iterable, e.g. a generator of rendered frames
+    return write_ild_sections((encode_frame(params, rframe, frame_index, 0, center)
+                               for frame_index, rframe in enumerate(rframes)), path)
+
+def render_svg(params, svg_path, optimize=True, chain=None):
+    # with a FrameChain the frame is ordered like the previous one in the
+    # chain and starts where it left the beam; the chain is then advanced
+    hits, misses = path_cache.hits, path_cache.misses
+    t = time.perf_counter()
+    frame = load_svg(svg_path)
+    params.reset_stats()
+    params.time_parse = time.perf_counter() - t
+    params.parse_cache_hits = path_cache.hits - hits
+    params.parse_cache_misses = path_cache.misses - misses
+    t = time.perf_counter()
+    start = chain.pos if chain is not None else None
+    frame.cull(params)
+    frame.merge(params)
+    frame.simplify(params)
+    if optimize:
+        if chain is not None and chain.hint:
+            frame.reorder(chain.hint, start, params.rotate_closed, params.coherent_tolerance)
         else:
-            offx = 0
-            offy = 0
-            width = 2*max(abs(min_x), abs(max_x))
-            height = 2*max(abs(min_y), abs(max_y))
-
-        scale = 1
-
-        if width > 65534 or height > 65534:
-            smax = max(width, height)
-            scale = 65534.0/smax
-            print("Scaling to %.02f%% due to overflow"%(scale*100))
-
-        if len(rframe) >= 65535:
-            raise ValueError("Too many points (%d, max 65535)"%len(rframe))
-
-        samples = len(rframe)
-
-        dout = b""
-        for i, sample in enumerate(rframe):
-            x, y = sample.coord
-            x += offx
-            y += offy
-            x *= scale
-            y *= scale
-            x = int(x)
-            y = int(y)
-            mode = 0
-            if i == len(rframe) - 1:
-                mode |= 0x80
-            if params.invert:
-                sample.on = not sample.on
-            if params.force:
-                sample.on = True
-            if not sample.on:
-                mode |= 0x40
-            if abs(x) > 32767:
-                raise ValueError("X out of bounds: %d"%x)
-            if abs(y) > 32767:
-                raise ValueError("Y out of bounds: %d"%y)
-            dout += struct.pack(">hhBB",x,-y,mode,0x01 if sample.on else 0x00)
-
-        hdr = struct.pack(">4s3xB8s8sHHHBx", b"ILDA", 1, b"svg2ilda", b"", samples, frame_index, total_frames, 0)
-        fout.write(hdr)
-        fout.write(dout)
-    hdr = struct.pack(">4s3xB8s8sHHHBx", b"ILDA", 0, b"svg2ilda", b"", 0, 0, total_frames, 0)
-    fout.write(hdr)
-    fout.close()
+            frame.sort(params.rotate_closed, start or (0,0))
+        frame.refine(params, start)
+    params.time_sort = time.perf_counter() - t
+    t = time.perf_counter()
+    budget = frame_budget(params)
+    if budget:
+        rframe = render_budget(params, frame, budget, start)
+    else:
+        rframe = frame.render(params, start=start)
+    params.time_render = time.perf_counter() - t
+    if chain is not None and frame.objects:
+        chain.hint = order_hint(frame.objects)
+        chain.pos = frame.objects[-1].endpos()
+    return rframe
+
+def encoded_points(params, rframe):
+    # encode_frame turns the first lit sample into extra_first_dwell samples
+    points = len(rframe)
+    if 1 in rframe.on:
+        points += params.extra_first_dwell - 1
+    return points
+
+def render_budget(params, frame, budget, start=None):
+    # render with the finest settings that fit the point budget, then pad the
+    # frame with blanked samples so every frame has exactly budget points
+    # fit_budget settles the scale with exact counts, so the frame fits
+    # unless it does not even fit at MAX_SCALE
+    scale, rparams = fit_budget(frame, params, budget, start)
+    rframe = frame.render(rparams, start=start)
+    points = encoded_points(params, rframe)
+    for name in params.stat_names:
+        setattr(params, name, getattr(rparams, name))
+    if len(rframe) and points < budget:
+        rframe.dwell(rframe.x[-1], rframe.y[-1], budget - points, False)
+        points = budget
+    # report the points as written, with the first dwell and the padding
+    params.points = points
+    params.budget_scale = scale
+    params.budget_points = points
+    return rframe
+
+def frame_error(name, e):
+    # a plain ValueError for a failed frame: parser exceptions hold the open
+    # file and cannot be sent back from a pool worker
+    message = str(e)
+    if not message.startswith(str(name)):
+        # parse errors already name the file
+        message = "%s: %s"%(name, message)
+    return ValueError(message)
+
+def convert_svg(job):
+    # worker entry point: parse, sort, render and encode one frame
+    params, svg_path, frame_index, optimize, center, chain = job
+    params = copy.copy(params)
+    try:
+        rframe = render_svg(params, svg_path, optimize, chain)
+        t = time.perf_counter()
+        data = encode_frame(params, rframe, frame_index, 0, center)
+        params.time_encode = time.perf_counter() - t
+    except Exception as e:
+        raise frame_error(svg_path, e) from None
+    return data, params.stats()
+
+def render_frames(params, svg_paths, optimize=True, center=True, jobs=1, cache=None, profiler=None):
+    # yields (svg_path, section, stats) in frame order. Frames whose content
+    # key is already cached, or repeats an earlier frame, are not rendered.
+    # With a profiler (see instrument.FrameProfiler) frames render in this process.
+    convert = convert_svg
+    if profiler is not None:
+        convert = functools.partial(profiler.run, convert_svg)
+        jobs = 1
+    if params.coherent and optimize:
+        # every frame depends on the one before it: render them all, in sequence
+        chain = FrameChain()
+        for frame_index, svg_path in enumerate(svg_paths):
+            data, stats = convert((params, svg_path, frame_index, optimize, center, chain))
+            yield svg_path, data, stats
+        return
+    if cache is None:
+        cache = FrameCache()
+    keys = []
+    render = []
+    seen = set()
+    for svg_path in svg_paths:
+        with open(svg_path, "rb") as f:
+            key = frame_key(f.read(), params, optimize, center)
+        keys.append(key)
+        render.append(key not in seen and key not in cache)
+        seen.add(key)
+    work = ((params, svg_paths[i], i, optimize, center, None) for i in range(len(svg_paths)) if render[i])
+
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(convert_svg, work)
+    else:
+        results = map(convert, work)
+    try:
+        for frame_index, (svg_path, key) in enumerate(zip(svg_paths, keys)):
+            entry = None
+            if not render[frame_index]:
+                entry = cache.get(key)
+            if entry is not None:
+                payload, stats = entry
+                yield svg_path, frame_section(payload, frame_index, 0), cached_stats(stats)
+                continue
+            if render[frame_index]:
+                data, stats = next(results)
+                cache.misses += 1
+            else:
+                # evicted since we planned the run
+                data, stats = convert((params, svg_path, frame_index, optimize, center, None))
+            cache.put(key, data[ILDA_HEADER.size:], stats)
+            yield svg_path, data, stats
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def watch(params, svg_directory, path, optimize=True, center=True, jobs=1, cache=None, interval=0.2, verbose=True):
+    # stay resident and rewrite the ILD file whenever SVGs in the directory
+    # change; only new or modified files are rendered again. In coherent
+    # mode every frame depends on the ones before it, so everything from
+    # the first changed frame on is rendered again
+    if cache is None:
+        cache = FrameCache()
+    frames = {}
+    # coherent mode: the files in the order last rendered, and the chain
+    # state (order hint, beam position) after each of them
+    order = []
+    chains = []
+    while True:
+        svg_files = sorted([f for f in os.listdir(svg_directory) if f.endswith('.svg')])
+        changed = []
+        for svg_file in svg_files:
+            try:
+                st = os.stat(os.path.join(svg_directory, svg_file))
+            except FileNotFoundError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            if svg_file not in frames or frames[svg_file][0] != stamp:
+                changed.append((svg_file, stamp))
+        removed = set(frames) - set(svg_files)
+
+        if changed or removed:
+            start = time.time()
+            for svg_file in removed:
+                del frames[svg_file]
+            if params.coherent and optimize:
+                updated = render_chain(params, svg_directory, svg_files, dict(changed), frames, order, chains, center)
+                order = list(svg_files)
+            else:
+                updated = len(changed)
+                render_changed(params, svg_directory, changed, frames, optimize, center, jobs, cache)
+            names = [f for f in svg_files if f in frames and frames[f][1] is not None]
+            write_ild_sections((frame_section(frames[f][1], i, 0) for i, f in enumerate(names)), path)
+            if verbose:
+                print("Updated %d frames, wrote %d in %.3fs"%(updated, len(names), time.time() - start))
+        time.sleep(interval)
+
+def update_frame(frames, svg_file, stamp, render):
+    # store the (section, stats) render() returns in frames; if it fails,
+    # keep the last good render (if any) until the file changes again
+    try:
+        data, stats = render()
+    except Exception as e:
+        print("%s: %s"%(svg_file, e))
+        old = frames.get(svg_file)
+        frames[svg_file] = (stamp,) + (old[1:] if old else (None, None))
+        return
+    frames[svg_file] = (stamp, bytes(data[ILDA_HEADER.size:]), stats)
+
+def render_changed(params, svg_directory, changed, frames, optimize, center, jobs, cache):
+    # render the changed files into frames, as {file: (stamp, payload, stats)}
+    try:
+        svg_paths = [os.path.join(svg_directory, svg_file) for svg_file, stamp in changed]
+        rendered = render_frames(params, svg_paths, optimize, center, jobs, cache)
+        for (svg_file, stamp), (_, data, stats) in zip(changed, rendered):
+            frames[svg_file] = (stamp, bytes(data[ILDA_HEADER.size:]), stats)
+    except Exception:
+        # a file is broken (or half saved): render the rest one by one
+        for svg_file, stamp in changed:
+            if svg_file in frames and frames[svg_file][0] == stamp:
+                continue
+            svg_path = os.path.join(svg_directory, svg_file)
+            update_frame(frames, svg_file, stamp,
+                         lambda: next(render_frames(params, [svg_path], optimize, center, 1, cache))[1:])
+
+def render_chain(params, svg_directory, svg_files, stamps, frames, order, chains, center):
+    # coherent mode: render again from the first file that changed, moved or
+    # follows a removed one, starting from the chain state of the frame
+    # before it. chains is updated in place; returns the number of frames rendered
+    first = 0
+    while (first < len(svg_files) and first < len(order) and svg_files[first] == order[first]
+           and svg_files[first] not in stamps):
+        first += 1
+    chain = FrameChain()
+    if first > 0:
+        chain.hint, chain.pos = chains[first - 1]
+    del chains[first:]
+    for frame_index in range(first, len(svg_files)):
+        svg_file = svg_files[frame_index]
+        stamp = stamps.get(svg_file)
+        if stamp is None:
+            if svg_file not in frames:
+                # vanished before it could be looked at
+                chains.append((chain.hint, chain.pos))
+                continue
+            stamp = frames[svg_file][0]
+        svg_path = os.path.join(svg_directory, svg_file)
+        update_frame(frames, svg_file, stamp,
+                     lambda: convert_svg((params, svg_path, frame_index, True, center, chain)))
+        chains.append((chain.hint, chain.pos))
+    return len(svg_files) - first
 
 if __name__ == "__main__":
     optimize = True
     verbose = True
     center = True
+    jobs = 1
+    cache_dir = None
+    cache_size = 1024
+    watching = False
+    stats_file = None
+    profiler = None
     params = RenderParameters()
 
-    if sys.argv[1] == "-q":
-        verbose = False
-        sys.argv = [sys.argv[0]] + sys.argv[2:]
-
-    if sys.argv[1] == "-noopt":
-        optimize = False
-        sys.argv = [sys.argv[0]] + sys.argv[2:]
-
-    if sys.argv[1] == "-noctr":
-        center = False
-        sys.argv = [sys.argv[0]] + sys.argv[2:]
+    args = sys.argv[1:]
+    while args and args[0].startswith("-"):
+        opt = args.pop(0)
+        if opt == "-q":
+            verbose = False
+        elif opt == "-noopt":
+            optimize = False
+        elif opt == "-noctr":
+            center = False
+        elif opt == "-cfg":
+            params.load(args.pop(0))
+        elif opt == "-j":
+            jobs = int(args.pop(0)) or os.cpu_count()
+        elif opt == "-budget":
+            params.rate = float(args.pop(0))
+            params.fps = float(args.pop(0))
+        elif opt == "-coherent":
+            params.coherent = True
+        elif opt in ("-watch", "--watch"):
+            watching = True
+        elif opt == "-cache":
+            cache_dir = args.pop(0)
+        elif opt == "-cachesize":
+            cache_size = float(args.pop(0))
+        elif opt == "-stats":
+            stats_file = args.pop(0)
+        elif opt == "-profile":
+            profiler = FrameProfiler(int(args.pop(0)))
+        elif opt == "-profilemem":
+            profiler = FrameProfiler(int(args.pop(0)), memory=True)
+        else:
+            sys.exit("Unknown option: %s"%opt)
 
-    if sys.argv[1] == "-cfg":
-        params.load(sys.argv[2])
-        sys.argv = [sys.argv[0]] + sys.argv[3:]
+    svg_directory = args[0]
+    if watching:
+        try:
+            watch(params, svg_directory, args[1], optimize, center, jobs,
+                  FrameCache(cache_dir, int(cache_size * (1 << 20))), verbose=verbose)
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
 
-    svg_directory = sys.argv[1]
     svg_files = sorted([f for f in os.listdir(svg_directory) if f.endswith('.svg')])
+    svg_paths = [os.path.join(svg_directory, svg_file) for svg_file in svg_files]
+    cache = FrameCache(cache_dir, int(cache_size * (1 << 20)))
+    writer = None
+    if stats_file:
+        writer = StatsWriter(stats_file, params.stat_names)
 
-    rframes = []
+    def sections():
+        rendered = render_frames(params, svg_paths, optimize, center, jobs, cache, profiler)
+        for frame_index, (svg_path, data, stats) in enumerate(rendered):
+            params.add_stats(stats)
+            if writer is not None:
+                writer.write(frame_index, os.path.basename(svg_path), stats)
+            if verbose and params.fps > 0:
+                print("%s: %d points (budget %d, scale %.3f)"%(os.path.basename(svg_path),
+                      stats["budget_points"], frame_budget(params), stats["budget_scale"]))
+            elif verbose:
+                print("%s: %d points"%(os.path.basename(svg_path), stats["points"]))
+            yield data
 
-    for svg_file in svg_files:
-        svg_path = os.path.join(svg_directory, svg_file)
-        if verbose:
-            print(f"Parse {svg_file}")
-        frame = load_svg(svg_path)
-        if verbose:
-            print("Done")
-
-        if optimize:
-            frame.sort()
-
-        if verbose:
-            print("Render")
-        rframe = frame.render(params)
-        rframes.append(rframe)
-        if verbose:
-            print("Done")
-
-    write_ild(params, rframes, sys.argv[2], center)
+    params.reset_stats()
+    try:
+        total_frames = write_ild_sections(sections(), args[1])
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if verbose:
+        print("Wrote %d frames, %d points"%(total_frames, params.points))
+        print("Frame cache: %d hits, %d misses"%(cache.hits, cache.misses))
+        print("Path data cache: %d hits, %d misses"%(params.parse_cache_hits, params.parse_cache_misses))
+        if params.clip or params.min_size > 0:
+            print("Culled: %d outside, %d too small, %d clipped"%(params.culled_paths, params.culled_small, params.clipped_paths))
+        if params.merge:
+            print("Merged: %d paths"%params.merged_paths)
+        if params.simplify > 0:
+            print("Simplified: %d segments, %d points removed"%(params.simplify_segments, params.simplify_points))
+        print("Time: parse %.3fs, sort %.3fs, render %.3fs, encode %.3fs"%(
+              params.time_parse, params.time_sort, params.time_render, params.time_encode))
+    if profiler is not None:
+        print("Slowest frames:")
+        print(profiler.report())
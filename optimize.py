@@ -0,0 +1,252 @@
+import math
+import time
+from spatial import PointTree
+
+
+def dist(a, b):
+    # None stands for "anywhere": moving to or from it is free
+    if a is None or b is None:
+        return 0.0
+    return math.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2)
+
+def blank_moves(objects, start=None):
+    # without a start position LaserFrame.render closes the loop, so the last
+    # object travels back to the first; with one, the frame is an open path
+    # that is entered from start
+    n = len(objects)
+    if start is not None and n:
+        yield dist(start, objects[0].startpos())
+        n -= 1
+    for i in range(n):
+        yield dist(objects[i].endpos(), objects[(i+1) % len(objects)].startpos())
+
+def blank_travel(objects, start=None):
+    return sum(blank_moves(objects, start))
+
+def trip_points(objects, params, start=None):
+    # samples PathLine.render emits for the blank moves (dwells don't depend on order)
+    return sum(int(d / params.off_speed) + 1 for d in blank_moves(objects, start))
+
+
+class TourOptimizer(object):
+    # 2-opt / or-opt refinement of a cyclic order of paths
+    #
+    # Paths are kept as indices with a reversed flag, and only turned into
+    # reversed LaserPath objects once the search is over. For an open path
+    # from a fixed start, a pinned zero-length stop at the start position
+    # takes position 0 and the move back to it is free.
+    def __init__(self, objects, params, start=None):
+        self.objects = objects
+        self.params = params
+        self.open = start is not None
+        self.starts = [o.startpos() for o in objects]
+        self.ends = [o.endpos() for o in objects]
+        self.order = list(range(len(objects)))
+        self.flip = [False] * len(objects)
+        if self.open:
+            self.starts.append(start)
+            self.ends.append(start)
+            self.flip.append(False)
+            self.order.insert(0, len(objects))
+        self.deadline = None
+        if params.opt_time > 0:
+            self.deadline = time.time() + params.opt_time
+    def s(self, k):
+        if k == len(self.order):
+            if self.open:
+                return None
+            k = 0
+        i = self.order[k]
+        return self.ends[i] if self.flip[i] else self.starts[i]
+    def e(self, k):
+        i = self.order[k % len(self.order)]
+        return self.starts[i] if self.flip[i] else self.ends[i]
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+    def reverse(self, i, j):
+        # reverse positions i..j, flipping every path in between
+        chain = self.order[i:j+1]
+        chain.reverse()
+        for o in chain:
+            self.flip[o] = not self.flip[o]
+        self.order[i:j+1] = chain
+    def two_opt(self):
+        n = len(self.order)
+        improved = False
+        for i in range(1, n):
+            if self.expired():
+                break
+            a = self.e(i-1)
+            b = self.s(i)
+            for j in range(i, n):
+                c = self.e(j)
+                d = self.s(j+1)
+                delta = dist(a, c) + dist(b, d) - dist(a, b) - dist(c, d)
+                if delta < -1e-12:
+                    self.reverse(i, j)
+                    b = self.s(i)
+                    improved = True
+        return improved
+    def or_opt(self):
+        # move chains of up to three paths to a better place, in either direction
+        n = len(self.order)
+        improved = False
+        for length in (1, 2, 3):
+            i = 1
+            while i + length <= n:
+                if self.expired():
+                    return improved
+                last = i + length - 1
+                a = self.e(i-1)
+                b = self.s(i)
+                c = self.e(last)
+                d = self.s(last+1)
+                gain = dist(a, b) + dist(c, d) - dist(a, d)
+                best = None
+                for p in range(n):
+                    if i-1 <= p <= last:
+                        continue
+                    x = self.e(p)
+                    y = self.s(p+1)
+                    base = gain + dist(x, y)
+                    fwd = dist(x, b) + dist(c, y)
+                    rev = dist(x, c) + dist(b, y)
+                    if fwd < base - 1e-12 and (best is None or fwd - base < best[0]):
+                        best = (fwd - base, p, False)
+                    if rev < base - 1e-12 and (best is None or rev - base < best[0]):
+                        best = (rev - base, p, True)
+                if best is None:
+                    i += 1
+                    continue
+                _, p, rev = best
+                chain = self.order[i:last+1]
+                if rev:
+                    chain.reverse()
+                    for o in chain:
+                        self.flip[o] = not self.flip[o]
+                rest = self.order[:i] + self.order[last+1:]
+                at = p + 1 if p < i else p - length + 1
+                self.order = rest[:at] + chain + rest[at:]
+                improved = True
+        return improved
+    def run(self):
+        if len(self.order) - self.open < 3:
+            return self.objects
+        passes = 0
+        while not self.expired():
+            improved = self.two_opt()
+            improved = self.or_opt() or improved
+            passes += 1
+            if not improved or passes == self.params.opt_passes:
+                break
+        out = []
+        for i in self.order:
+            if i == len(self.objects):
+                continue
+            o = self.objects[i]
+            out.append(o.reverse() if self.flip[i] else o)
+        return out
+
+def rotate_closed(objects, start=None):
+    # enter each closed path at the vertex that minimises the blank moves around it
+    out = list(objects)
+    n = len(out)
+    if n < 2 and start is None:
+        return out
+    for i, o in enumerate(out):
+        if not o.is_closed():
+            continue
+        if i == 0 and start is not None:
+            prev = start
+        else:
+            prev = out[i-1].endpos()
+        if i == n-1 and start is not None:
+            nxt = None
+        else:
+            nxt = out[(i+1) % n].startpos()
+        best = min(range(len(o.segments)),
+                   key=lambda k: (dist(prev, o.segments[k].start) + dist(o.segments[k].start, nxt), k))
+        if best:
+            out[i] = o.rotate(best)
+    return out
+
+def refine_order(objects, params, start=None):
+    # improve a (greedy) order, keeping it only if it needs fewer trip samples
+    before = blank_travel(objects, start)
+    refined = objects
+    if params.opt_time > 0 or params.opt_passes > 0:
+        refined = TourOptimizer(refined, params, start).run()
+    if params.rotate_closed:
+        refined = rotate_closed(refined, start)
+    if refined is not objects:
+        saved = trip_points(objects, params, start) - trip_points(refined, params, start)
+        if saved >= 0:
+            params.points_trip_saved += saved
+            params.blank_travel_saved += before - blank_travel(refined, start)
+            objects = refined
+    params.blank_travel += blank_travel(objects, start)
+    return objects
+
+
+def path_signature(path):
+    # segment count, vertex centroid and entry point of a path
+    n = len(path.segments)
+    cx = sum(s.start[0] for s in path.segments) / n
+    cy = sum(s.start[1] for s in path.segments) / n
+    return (n, (cx, cy), path.startpos())
+
+def order_hint(objects):
+    return [path_signature(o) for o in objects]
+
+class FrameChain(object):
+    # carries the path order and final beam position from one frame to the next
+    def __init__(self, pos=(0,0)):
+        self.hint = None
+        self.pos = pos
+
+def coherent_order(objects, hint, start, rotate_closed=False, tolerance=0.05):
+    # seed the order from the previous frame's: every path that matches one
+    # of the hint (same segment count, centroid within tolerance) takes its
+    # place and direction, then the remaining paths are inserted where they
+    # add the least blank travel. Returns None if too little matches.
+    trees = {}
+    for i, o in enumerate(objects):
+        n, c, _ = path_signature(o)
+        trees.setdefault(n, []).append((c, i))
+    trees = dict((n, PointTree(points)) for n, points in trees.items())
+
+    order = []
+    for n, c, s in hint:
+        tree = trees.get(n)
+        found = tree.nearest(c) if tree else None
+        if found is None or found[0] > tolerance**2:
+            continue
+        i = found[1]
+        tree.remove(i)
+        o = objects[i]
+        if rotate_closed and o.is_closed():
+            k = min(range(len(o.segments)), key=lambda k: (dist(o.segments[k].start, s), k))
+            if k:
+                o = o.rotate(k)
+        elif dist(o.endpos(), s) < dist(o.startpos(), s):
+            o = o.reverse()
+        order.append(o)
+
+    rest = sorted(i for tree in trees.values() for i in tree.keys())
+    if len(rest) > len(order):
+        return None
+    for i in rest:
+        o = objects[i]
+        candidates = [o]
+        if not o.is_closed():
+            candidates.append(o.reverse())
+        best = None
+        for p in range(len(order) + 1):
+            a = start if p == 0 else order[p-1].endpos()
+            b = order[p].startpos() if p < len(order) else None
+            for c in candidates:
+                delta = dist(a, c.startpos()) + dist(c.endpos(), b) - dist(a, b)
+                if best is None or delta < best[0]:
+                    best = (delta, p, c)
+        order.insert(best[1], best[2])
+    return order
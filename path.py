@@ -1,40 +1,203 @@
 import math
 
 
+def affine(m, points):
+    # apply an SVG matrix (a,b,c,d,e,f) to a sequence of points
+    a,b,c,d,e,f = m
+    return [(a*x + c*y + e, b*x + d*y + f) for x,y in points]
+
+def flatten_bezier(start, cp1, cp2, end, params):
+    out, rate_divs, flatness_divs = subdivide_bezier(start, cp1, cp2, end, params.on_speed, params.flatness)
+    params.rate_divs += rate_divs
+    params.flatness_divs += flatness_divs
+    params.points_bezier += len(out)
+    return out
+
+def subdivide_bezier(start, cp1, cp2, end, on_speed, flatness):
+    # de Casteljau subdivision at t=0.5 until each piece is shorter than
+    # on_speed and flat enough; returns the end point of every piece and
+    # the number of rate and flatness subdivisions.
+    # runs on an explicit stack of plain tuples instead of recursing
+    rate_divs = flatness_divs = 0
+    out = []
+    stack = [start + cp1 + cp2 + end]
+    while stack:
+        x0,y0,x1,y1,x2,y2,x3,y3 = stack.pop()
+        dx = x3-x0
+        dy = y3-y0
+        length = math.sqrt((dx**2) + (dy**2))
+        subdivide = False
+        if length > on_speed:
+            subdivide = True
+            rate_divs += 1
+        else:
+            ux = (3.0*x1 - 2.0*x0 - x3)**2
+            uy = (3.0*y1 - 2.0*y0 - y3)**2
+            vx = (3.0*x2 - 2.0*x3 - x0)**2
+            vy = (3.0*y2 - 2.0*y3 - y0)**2
+            if ux < vx:
+                ux = vx
+            if uy < vy:
+                uy = vy
+            if (ux+uy) > flatness:
+                subdivide = True
+                flatness_divs += 1
+        if subdivide:
+            mcx = (x1 + x2) * 0.5
+            mcy = (y1 + y2) * 0.5
+            ax1 = (x0 + x1) * 0.5
+            ay1 = (y0 + y1) * 0.5
+            ax2 = (ax1 + mcx) * 0.5
+            ay2 = (ay1 + mcy) * 0.5
+            bx2 = (x2 + x3) * 0.5
+            by2 = (y2 + y3) * 0.5
+            bx1 = (bx2 + mcx) * 0.5
+            by1 = (by2 + mcy) * 0.5
+            xm = (ax2 + bx1) * 0.5
+            ym = (ay2 + by1) * 0.5
+            # second half first, so the first half is popped next
+            stack.append((xm,ym,bx1,by1,bx2,by2,x3,y3))
+            stack.append((x0,y0,ax1,ay1,ax2,ay2,xm,ym))
+        else:
+            out.append((x3,y3))
+    return out, rate_divs, flatness_divs
+
+def split_bezier(start, cp1, cp2, end):
+    # de Casteljau at t=0.5: the control points of both halves
+    x0,y0 = start
+    x1,y1 = cp1
+    x2,y2 = cp2
+    x3,y3 = end
+    mcx = (x1 + x2) * 0.5
+    mcy = (y1 + y2) * 0.5
+    ax1 = (x0 + x1) * 0.5
+    ay1 = (y0 + y1) * 0.5
+    ax2 = (ax1 + mcx) * 0.5
+    ay2 = (ay1 + mcy) * 0.5
+    bx2 = (x2 + x3) * 0.5
+    by2 = (y2 + y3) * 0.5
+    bx1 = (bx2 + mcx) * 0.5
+    by1 = (by2 + mcy) * 0.5
+    xm = (ax2 + bx1) * 0.5
+    ym = (ay2 + by1) * 0.5
+    return (start, (ax1,ay1), (ax2,ay2), (xm,ym)), ((xm,ym), (bx1,by1), (bx2,by2), end)
+
+def estimate_bezier(start, cp1, cp2, end, on_speed, flatness, split=True):
+    # approximate len(subdivide_bezier(...)) without subdividing: halving a
+    # piece halves its length and quarters 3*cp1-2*start-end (the flatness
+    # test squares that), so a curve of roughly even speed and bend needs
+    # 2^depth pieces for the depth where both tests pass. The curve is split
+    # once first so each half gets its own depth.
+    x0,y0 = start
+    x1,y1 = cp1
+    x2,y2 = cp2
+    x3,y3 = end
+    chord = math.sqrt((x3-x0)**2 + (y3-y0)**2)
+    ux = (3.0*x1 - 2.0*x0 - x3)**2
+    uy = (3.0*y1 - 2.0*y0 - y3)**2
+    vx = (3.0*x2 - 2.0*x3 - x0)**2
+    vy = (3.0*y2 - 2.0*y3 - y0)**2
+    bend = max(ux, vx) + max(uy, vy)
+    if chord <= on_speed and bend <= flatness:
+        return 1
+    if split:
+        first, second = split_bezier(start, cp1, cp2, end)
+        return (estimate_bezier(*first, on_speed, flatness, False) +
+                estimate_bezier(*second, on_speed, flatness, False))
+    # arc length lies between the chord and the control polygon
+    poly = (math.sqrt((x1-x0)**2 + (y1-y0)**2) + math.sqrt((x2-x1)**2 + (y2-y1)**2) +
+            math.sqrt((x3-x2)**2 + (y3-y2)**2))
+    length = (chord + poly) * 0.5
+    depth = 0
+    if length > on_speed:
+        depth = int(math.ceil(math.log(length / on_speed, 2)))
+    if bend > flatness:
+        depth = max(depth, int(math.ceil(math.log(bend / flatness, 16))))
+    return 1 << depth
+
+def simplify_polyline(points, tolerance):
+    # Ramer-Douglas-Peucker: indices of the points to keep so that no dropped
+    # point is further than tolerance from the simplified line
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+    tol2 = tolerance * tolerance
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n-1)]
+    while stack:
+        a, b = stack.pop()
+        ax, ay = points[a]
+        bx, by = points[b]
+        dx, dy = bx-ax, by-ay
+        den = dx*dx + dy*dy
+        worst, at = -1.0, -1
+        for i in range(a+1, b):
+            px, py = points[i]
+            if den == 0:
+                d = (px-ax)**2 + (py-ay)**2
+            else:
+                cross = dx*(py-ay) - dy*(px-ax)
+                d = cross*cross / den
+            if d > worst:
+                worst, at = d, i
+        if worst > tol2:
+            keep[at] = True
+            stack.append((at, b))
+            stack.append((a, at))
+    return [i for i in range(n) if keep[i]]
+
+
 class PathLine(object):
     def __init__(self, start, end, on=True):
         self.start = start
         self.end = end
         self.on = on
     def copy(self):
-        return PathLine(self.start, self.end)
+        return PathLine(self.start, self.end, self.on)
     def transform(self, func):
         self.start = func(self.start)
         self.end = func(self.end)
-    def render(self, params):
-        from laser import LaserSample
+    def affine(self, m):
+        self.start, self.end = affine(m, (self.start, self.end))
+    def render(self, params, out=None):
+        from laser import SampleBuffer
 
+        if out is None:
+            out = SampleBuffer()
         dx = self.end[0] - self.start[0]
         dy = self.end[1] - self.start[1]
-        length = math.sqrt(dx**2 + dy**2)
-        if self.on:
-            steps = int(length / params.on_speed) + 1
-        else:
-            steps = int(length / params.off_speed) + 1
+        steps = self.count_points(params)
         dx /= steps
         dy /= steps
-        out = []
-        for i in range(1, steps+1):
-            x = self.start[0] + i * dx
-            y = self.start[1] + i * dy
-            out.append(LaserSample((int(x*params.width),int(y*params.height)), self.on))
-            if self.on:
-                params.points_line += 1
-            else:
-                params.points_trip += 1
+        x0, y0 = self.start
+        w, h = params.width, params.height
+        out.extend([int((x0 + i * dx)*w) for i in range(1, steps+1)],
+                   [int((y0 + i * dy)*h) for i in range(1, steps+1)], self.on)
+        if self.on:
+            params.points_line += steps
+        else:
+            params.points_trip += steps
         return out
+    def count_points(self, params, exact=True):
+        dx = self.end[0] - self.start[0]
+        dy = self.end[1] - self.start[1]
+        length = math.sqrt(dx**2 + dy**2)
+        if self.on:
+            return int(length / params.on_speed) + 1
+        else:
+            return int(length / params.off_speed) + 1
+    def last_sample(self, params):
+        # the last sample render() emits, computed the same way
+        steps = self.count_points(params)
+        dx = (self.end[0] - self.start[0]) / steps
+        dy = (self.end[1] - self.start[1]) / steps
+        x0, y0 = self.start
+        return int((x0 + steps * dx)*params.width), int((y0 + steps * dy)*params.height)
     def reverse(self):
         return PathLine(self.end, self.start, self.on)
+    def points(self):
+        return self.start, self.end
     def scp(self):
         return self.end
     def ecp(self):
@@ -53,8 +216,14 @@ class PathBezier3(object):
         self.start = func(self.start)
         self.cp = func(self.cp)
         self.end = func(self.end)
-    def render(self, params):
+    def affine(self, m):
+        self.start, self.cp, self.end = affine(m, (self.start, self.cp, self.end))
+    def render(self, params, out=None):
         # just use PathBezier4, meh
+        return self.cubic().render(params, out)
+    def count_points(self, params, exact=True):
+        return self.cubic().count_points(params, exact)
+    def cubic(self):
         sx,sy = self.start
         cx,cy = self.cp
         ex,ey = self.end
@@ -63,9 +232,13 @@ class PathBezier3(object):
         c1y = (1.0/3) * cy + (2.0/3) * sy
         c2x = (1.0/3) * cx + (2.0/3) * ex
         c2y = (1.0/3) * cy + (2.0/3) * ey
-        return PathBezier4(self.start, (c1x,c1y), (c2x,c2y), self.end).render()
+        return PathBezier4(self.start, (c1x,c1y), (c2x,c2y), self.end)
+    def last_sample(self, params):
+        return int(self.end[0]*params.width), int(self.end[1]*params.height)
     def reverse(self):
         return PathBezier3(self.end, self.cp, self.start)
+    def points(self):
+        return self.start, self.cp, self.end
     def scp(self):
         return self.cp
     def ecp(self):
@@ -86,55 +259,30 @@ class PathBezier4(object):
         self.cp1 = func(self.cp1)
         self.cp2 = func(self.cp2)
         self.end = func(self.end)
+    def affine(self, m):
+        self.start, self.cp1, self.cp2, self.end = affine(m, (self.start, self.cp1, self.cp2, self.end))
 
-    def render(self, params):
-        from laser import LaserSample
+    def render(self, params, out=None):
+        from laser import SampleBuffer
 
-        x0,y0 = self.start
-        x1,y1 = self.cp1
-        x2,y2 = self.cp2
-        x3,y3 = self.end
-        dx = x3-x0
-        dy = y3-y0
-        length = math.sqrt((dx**2) + (dy**2))
-        subdivide = False
-        if length > params.on_speed:
-            subdivide = True
-            params.rate_divs += 1
-        else:
-            ux = (3.0*x1 - 2.0*x0 - x3)**2
-            uy = (3.0*y1 - 2.0*y0 - y3)**2
-            vx = (3.0*x2 - 2.0*x3 - x0)**2
-            vy = (3.0*y2 - 2.0*y3 - y0)**2
-            if ux < vx:
-                ux = vx
-            if uy < vy:
-                uy = vy
-            if (ux+uy) > params.flatness:
-                subdivide = True
-                params.flatness_divs += 1
-        if subdivide:
-            # de Casteljau at t=0.5
-            mcx = (x1 + x2) * 0.5
-            mcy = (y1 + y2) * 0.5
-            ax1 = (x0 + x1) * 0.5
-            ay1 = (y0 + y1) * 0.5
-            ax2 = (ax1 + mcx) * 0.5
-            ay2 = (ay1 + mcy) * 0.5
-            bx2 = (x2 + x3) * 0.5
-            by2 = (y2 + y3) * 0.5
-            bx1 = (bx2 + mcx) * 0.5
-            by1 = (by2 + mcy) * 0.5
-            xm = (ax2 + bx1) * 0.5
-            ym = (ay2 + by1) * 0.5
-            curve1 = PathBezier4((x0,y0),(ax1,ay1),(ax2,ay2),(xm,ym))
-            curve2 = PathBezier4((xm,ym),(bx1,by1),(bx2,by2),(x3,y3))
-            return curve1.render(params) + curve2.render(params)
-        else:
-            params.points_bezier += 1
-            return [LaserSample((int(x3*params.width),int(y3*params.height)))]
+        if out is None:
+            out = SampleBuffer()
+        w, h = params.width, params.height
+        points = flatten_bezier(self.start, self.cp1, self.cp2, self.end, params)
+        out.extend([int(x*w) for x,y in points], [int(y*h) for x,y in points])
+        return out
+    def count_points(self, params, exact=True):
+        if not exact:
+            return estimate_bezier(self.start, self.cp1, self.cp2, self.end, params.on_speed, params.flatness)
+        points, _, _ = subdivide_bezier(self.start, self.cp1, self.cp2, self.end, params.on_speed, params.flatness)
+        return len(points)
+    def last_sample(self, params):
+        # subdivision ends every curve exactly on its end point
+        return int(self.end[0]*params.width), int(self.end[1]*params.height)
     def reverse(self):
         return PathBezier4(self.end, self.cp2, self.cp1, self.start)
+    def points(self):
+        return self.start, self.cp1, self.cp2, self.end
     def scp(self):
         if self.cp1 != self.start:
             return self.cp1
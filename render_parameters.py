@@ -2,8 +2,12 @@
 
 class RenderParameters(object):
     def __init__(self):
-        # output sample rate
+        # output sample rate (points per second)
         self.rate = 48000
+        # frame rate for the point budget: with fps > 0 every frame is
+        # rendered with exactly rate/fps points, coarsening on_speed,
+        # off_speed, flatness and the dwells as far as needed (0 = off)
+        self.fps = 0.0
         # time to display (seconds)
         # use 0.0 for a single frame
         self.time = 0.0
@@ -38,23 +42,79 @@ class RenderParameters(object):
         # invert image (show inter-object trips)
         self.invert = False
         self.force = False
+        # merge runs of lines that stay within this distance of a straight
+        # line before rendering (normalised units, 2 = full width, 0 = off)
+        self.simplify = 0.0
+        # cut paths at the edge of the projection area ([-1,1] in both axes)
+        # and drop the ones outside it, instead of failing on out of bounds
+        self.clip = False
+        # drop paths whose bounding box is smaller than this (normalised units)
+        self.min_size = 0.0
+        # join open paths whose ends are at most merge_tolerance apart
+        self.merge = False
+        self.merge_tolerance = 0.0001
+        # let the path ordering enter closed paths at any vertex
+        self.rotate_closed = False
+        # order each frame like the previous one and start it where the
+        # previous frame left the beam (frames are rendered in sequence)
+        self.coherent = False
+        # how far a path may move between frames and still count as the same (normalised units)
+        self.coherent_tolerance = 0.05
+        # time budget for refining the path order after sorting (seconds, 0 = off)
+        self.opt_time = 0.0
+        # maximum number of refinement passes (0 = until no improvement)
+        self.opt_passes = 0
 
         self.reset_stats()
+
+    stat_names = (
+        "rate_divs",
+        "flatness_divs",
+        "objects",
+        "subpaths",
+        "points",
+        "points_line",
+        "points_trip",
+        "points_bezier",
+        "points_dwell_start",
+        "points_dwell_curve",
+        "points_dwell_corner",
+        "points_dwell_end",
+        "points_dwell_switch",
+        "points_on",
+        "blank_travel",
+        "blank_travel_saved",
+        "points_trip_saved",
+        "parse_cache_hits",
+        "parse_cache_misses",
+        "culled_paths",
+        "culled_small",
+        "clipped_paths",
+        "merged_paths",
+        "simplify_segments",
+        "simplify_points",
+        "budget_scale",
+        "budget_points",
+        "cache_hit",
+        "time_parse",
+        "time_sort",
+        "time_render",
+        "time_encode",
+    )
+
     def reset_stats(self):
-        self.rate_divs = 0
-        self.flatness_divs = 0
-        self.objects = 0
-        self.subpaths = 0
-        self.points = 0
-        self.points_line = 0
-        self.points_trip = 0
-        self.points_bezier = 0
-        self.points_dwell_start = 0
-        self.points_dwell_curve = 0
-        self.points_dwell_corner = 0
-        self.points_dwell_end = 0
-        self.points_dwell_switch = 0
-        self.points_on = 0
+        for name in self.stat_names:
+            setattr(self, name, 0)
+
+    def stats(self):
+        return dict((name, getattr(self, name)) for name in self.stat_names)
+
+    def settings(self):
+        return dict((name, value) for name, value in vars(self).items() if name not in self.stat_names)
+
+    def add_stats(self, stats):
+        for name, value in stats.items():
+            setattr(self, name, getattr(self, name) + value)
 
     def load(self, f):
         for line in open(f):
@@ -0,0 +1,110 @@
+class PointTree(object):
+    # k-d tree over 2D points with deletion and nearest-point queries
+    #
+    # Every point carries a sortable key. nearest() returns the point with the
+    # smallest (squared distance, key), so ties resolve the same way as a linear
+    # scan over the points in key order.
+    #
+    # The tree is stored implicitly: the node for the range [lo, hi) of the
+    # arrays is the point at its middle, m = (lo + hi) // 2, which splits the
+    # range along axis[m]. The tree splits at medians, so clustered points get
+    # as deep a tree as they need. Deleted points stay in place; alive[m]
+    # counts the live points below m so empty subtrees are skipped, and the
+    # tree is rebuilt once three quarters of its points are gone.
+    def __init__(self, points=()):
+        self.points = {}
+        for coord, key in points:
+            self.points[key] = coord
+        self.rebuild()
+    def __len__(self):
+        return len(self.points)
+    def keys(self):
+        return list(self.points)
+    def rebuild(self):
+        self.keyat = list(self.points)
+        n = len(self.keyat)
+        self.built = n
+        self.xs = [0.0] * n
+        self.ys = [0.0] * n
+        self.axis = [0] * n
+        self.alive = [0] * n
+        self.index = {}
+        order = [self.points[k] + (k,) for k in self.keyat]
+        stack = [(0, n)]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            part = order[lo:hi]
+            xs = [p[0] for p in part]
+            ys = [p[1] for p in part]
+            # split along the wider side of the range
+            axis = 0 if max(xs) - min(xs) >= max(ys) - min(ys) else 1
+            part.sort(key=lambda p: p[axis])
+            order[lo:hi] = part
+            m = (lo + hi) // 2
+            self.axis[m] = axis
+            self.alive[m] = hi - lo
+            stack.append((lo, m))
+            stack.append((m + 1, hi))
+        for i, (x, y, key) in enumerate(order):
+            self.xs[i] = x
+            self.ys[i] = y
+            self.keyat[i] = key
+            self.index[key] = i
+    def add(self, coord, key):
+        self.points[key] = coord
+        self.rebuild()
+    def remove(self, key):
+        del self.points[key]
+        i = self.index.pop(key)
+        # walk down from the root to i, one fewer live point on the way
+        lo, hi = 0, self.built
+        while True:
+            m = (lo + hi) // 2
+            self.alive[m] -= 1
+            if m == i:
+                break
+            if i < m:
+                hi = m
+            else:
+                lo = m + 1
+        self.keyat[i] = None
+        if len(self.points) * 4 < self.built:
+            self.rebuild()
+    def nearest(self, pos):
+        # returns (squared distance, key) or None if the tree is empty
+        if not self.points:
+            return None
+        x, y = pos
+        xs, ys, keyat, axis, alive = self.xs, self.ys, self.keyat, self.axis, self.alive
+        best_d = best_key = None
+        # walk down the near side of each split, keeping the far sides with
+        # the squared distance to their splitting line, a lower bound for
+        # every point in them
+        stack = [(0.0, 0, self.built)]
+        while stack:
+            bound, lo, hi = stack.pop()
+            while lo < hi:
+                if best_key is not None and bound > best_d:
+                    break
+                m = (lo + hi) // 2
+                if not alive[m]:
+                    break
+                px, py = xs[m], ys[m]
+                key = keyat[m]
+                if key is not None:
+                    d = (px-x)**2 + (py-y)**2
+                    if best_key is None or d < best_d or (d == best_d and key < best_key):
+                        best_d, best_key = d, key
+                diff = (x - px) if axis[m] == 0 else (y - py)
+                far = diff*diff
+                if far < bound:
+                    far = bound
+                if diff < 0:
+                    stack.append((far, m + 1, hi))
+                    hi = m
+                else:
+                    stack.append((far, lo, m))
+                    lo = m + 1
+        return best_d, best_key
@@ -3,6 +3,7 @@ from laser import LaserFrame, LaserPath
 from path import PathLine, PathBezier4, PathBezier3
 import re
 import math
+from collections import OrderedDict
 
 
 class SVGReader(xml.sax.handler.ContentHandler):
@@ -13,9 +14,19 @@ class SVGReader(xml.sax.handler.ContentHandler):
         self.matrix_stack = [(1,0,0,1,0,0)]
         self.style_stack = []
         self.defsdepth = 0
+        # geometry of elements with an id, for <use>: id -> [(matrix, paths)]
+        self.defs = {}
+        self.recorders = []
+        self.group_ids = []
     def endDocument(self):
-        self.frame.transform(self.tc)
+        pass
     def startElement(self, name, attrs):
+        if name in SHAPES and 'id' in attrs.keys():
+            self.startrecord(attrs['id'])
+        self.handleElement(name, attrs)
+        if name in SHAPES and 'id' in attrs.keys():
+            self.endrecord()
+    def handleElement(self, name, attrs):
         if name == "svg":
             self.dx = self.dy = 0
             if 'viewBox' in attrs.keys():
@@ -28,24 +39,27 @@ class SVGReader(xml.sax.handler.ContentHandler):
                     ws = ws.replace(r,"")
                 self.width = float(ws)
                 self.height = float(hs)
+            if len(self.matrix_stack) == 1:
+                # everything below is mapped straight into normalised space
+                self.matrix_stack[0] = self.tc()
         elif name == "path":
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 self.addPath(attrs['d'])
             if 'transform' in attrs.keys():
                 self.popmatrix()
         elif name in ("polyline","polygon"):
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 self.addPolyline(attrs['points'], name == "polygon")
             if 'transform' in attrs.keys():
                 self.popmatrix()
         elif name == "line":
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 x1, y1, x2, y2 = [float(attrs[x]) for x in ('x1','y1','x2','y2')]
                 self.addLine(x1, y1, x2, y2)
             if 'transform' in attrs.keys():
@@ -53,7 +67,7 @@ class SVGReader(xml.sax.handler.ContentHandler):
         elif name == "rect":
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 x1, y1, w, h = [float(attrs[x]) for x in ('x','y','width','height')]
                 self.addRect(x1, y1, x1+w, y1+h)
             if 'transform' in attrs.keys():
@@ -61,7 +75,7 @@ class SVGReader(xml.sax.handler.ContentHandler):
         elif name == "circle":
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 cx, cy, r = [float(attrs[x]) for x in ('cx','cy','r')]
                 self.addCircle(cx, cy, r)
             if 'transform' in attrs.keys():
@@ -69,12 +83,30 @@ class SVGReader(xml.sax.handler.ContentHandler):
         elif name == "ellipse":
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
-            if self.defsdepth == 0 and self.isvisible(attrs):
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
                 cx, cy, rx, ry = [float(attrs[x]) for x in ('cx','cy','rx','ry')]
                 self.addEllipse(cx, cy, rx, ry)
             if 'transform' in attrs.keys():
                 self.popmatrix()
-        elif name == 'g':
+        elif name == "use":
+            href = attrs.get('xlink:href', attrs.get('href', ''))
+            if 'transform' in attrs.keys():
+                self.transform(attrs['transform'])
+            else:
+                self.pushmatrix((1,0,0,1,0,0))
+            self.pushmatrix((1,0,0,1,float(attrs.get('x', 0)),float(attrs.get('y', 0))))
+            if (self.defsdepth == 0 or self.recorders) and self.isvisible(attrs):
+                for m, paths in self.defs.get(href[1:], ()):
+                    self.emit(paths, self.mmul(self.matrix_stack[-1], m))
+            self.popmatrix()
+            self.popmatrix()
+        elif name in ('g', 'symbol'):
+            self.group_ids.append(attrs.get('id'))
+            if 'id' in attrs.keys():
+                self.startrecord(attrs['id'])
+            if name == 'symbol':
+                # only drawn through <use>
+                self.defsdepth += 1
             if 'transform' in attrs.keys():
                 self.transform(attrs['transform'])
             else:
@@ -86,9 +118,13 @@ class SVGReader(xml.sax.handler.ContentHandler):
         elif name in ('defs','clipPath'):
             self.defsdepth += 1
     def endElement(self, name):
-        if name == 'g':
+        if name in ('g', 'symbol'):
             self.popmatrix()
             self.style_stack.pop()
+            if name == 'symbol':
+                self.defsdepth -= 1
+            if self.group_ids.pop() is not None:
+                self.endrecord()
         elif name in ('defs','clipPath'):
             self.defsdepth -= 1
     def mmul(self, m1, m2):
@@ -106,20 +142,10 @@ class SVGReader(xml.sax.handler.ContentHandler):
         self.matrix_stack.append(new_mat)
     def popmatrix(self):
         self.matrix_stack.pop()
-    def tc(self,coord):
-        vw = vh = max(self.width, self.height) / 2.0
-        x,y = coord
-        x -= self.width / 2.0 + self.dx
-        y -= self.height / 2.0 + self.dy
-        x = x / vw
-        y = y / vh
-        return (x,y)
-    def ts(self,coord):
-        a,b,c,d,e,f = self.matrix_stack[-1]
-        x,y = coord
-        nx = a*x + c*y + e
-        ny = b*x + d*y + f
-        return (nx,ny)
+    def tc(self):
+        # viewBox to normalised coordinates: centred, longer side -1..1
+        s = 2.0 / max(self.width, self.height)
+        return (s, 0, 0, s, -(self.width / 2.0 + self.dx) * s, -(self.height / 2.0 + self.dy) * s)
     def transform(self, data):
         ds = re.split(r"[ \r\n\t]*([a-z]+\([^)]+\)|,)[ \r\n\t]*", data)
         tokens = []
@@ -167,29 +193,49 @@ class SVGReader(xml.sax.handler.ContentHandler):
                 a = args[0] / 180.0 * math.pi
                 mat = self.mmul(mat, (1,math.tan(a),0,1,0,0))
         self.pushmatrix(mat)
+    def minv(self, m):
+        a,b,c,d,e,f = m
+        det = a*d - b*c
+        if det == 0:
+            return None
+        return (d/det, -b/det, -c/det, a/det, (c*f - d*e)/det, (b*e - a*f)/det)
+    def startrecord(self, id):
+        # collect geometry relative to the element's parent, so <use> can instance it
+        self.recorders.append((id, self.minv(self.matrix_stack[-1]), []))
+    def endrecord(self):
+        id, inv, items = self.recorders.pop()
+        if inv is not None:
+            self.defs[id] = items
+    def emit(self, paths, m=None, shared=True):
+        # paths are in element coordinates; shared paths (cached or recorded)
+        # are copied before they get transformed into the frame
+        if m is None:
+            m = self.matrix_stack[-1]
+        for id, inv, items in self.recorders:
+            if inv is not None:
+                items.append((self.mmul(inv, m), paths))
+            shared = True
+        if self.defsdepth == 0:
+            for path in paths:
+                if shared:
+                    path = path.copy()
+                path.affine(m)
+                self.frame.add(path)
     def addPath(self, data):
-        p = SVGPath(data)
-        for path in p.subpaths:
-            path.transform(self.ts)
-            self.frame.add(path)
+        self.emit(path_cache.get(data, lambda: SVGPath(data).subpaths))
     def addPolyline(self, data, close=False):
-        p = SVGPolyline(data, close)
-        for path in p.subpaths:
-            path.transform(self.ts)
-            self.frame.add(path)
+        self.emit(path_cache.get((data, close), lambda: SVGPolyline(data, close).subpaths))
     def addLine(self, x1, y1, x2, y2):
         path = LaserPath()
         path.add(PathLine((x1,y1), (x2,y2)))
-        path.transform(self.ts)
-        self.frame.add(path)
+        self.emit([path], shared=False)
     def addRect(self, x1, y1, x2, y2):
         path = LaserPath()
         path.add(PathLine((x1,y1), (x2,y1)))
         path.add(PathLine((x2,y1), (x2,y2)))
         path.add(PathLine((x2,y2), (x1,y2)))
         path.add(PathLine((x1,y2), (x1,y1)))
-        path.transform(self.ts)
-        self.frame.add(path)
+        self.emit([path], shared=False)
     def addCircle(self, cx, cy, r):
         cp = 0.55228475 * r
         path = LaserPath()
@@ -197,8 +243,7 @@ class SVGReader(xml.sax.handler.ContentHandler):
         path.add(PathBezier4((cx+r,cy), (cx+r,cy+cp), (cx+cp,cy+r), (cx,cy+r)))
         path.add(PathBezier4((cx,cy+r), (cx-cp,cy+r), (cx-r,cy+cp), (cx-r,cy)))
         path.add(PathBezier4((cx-r,cy), (cx-r,cy-cp), (cx-cp,cy-r), (cx,cy-r)))
-        path.transform(self.ts)
-        self.frame.add(path)
+        self.emit([path], shared=False)
     def addEllipse(self, cx, cy, rx, ry):
         cpx = 0.55228475 * rx
         cpy = 0.55228475 * ry
@@ -207,8 +252,7 @@ class SVGReader(xml.sax.handler.ContentHandler):
         path.add(PathBezier4((cx+rx,cy), (cx+rx,cy+cpy), (cx+cpx,cy+ry), (cx,cy+ry)))
         path.add(PathBezier4((cx,cy+ry), (cx-cpx,cy+ry), (cx-rx,cy+cpy), (cx-rx,cy)))
         path.add(PathBezier4((cx-rx,cy), (cx-rx,cy-cpy), (cx-cpx,cy-ry), (cx,cy-ry)))
-        path.transform(self.ts)
-        self.frame.add(path)
+        self.emit([path], shared=False)
     def isvisible(self, attrs):
         # skip elements with no stroke or fill
         # hacky but gets rid of some gunk
@@ -226,6 +270,65 @@ class SVGReader(xml.sax.handler.ContentHandler):
         return True
 
 
+SHAPES = ("path", "polyline", "polygon", "line", "rect", "circle", "ellipse", "use")
+
+
+class PathCache(object):
+    # parsed, untransformed subpaths by their source data, shared by every
+    # frame parsed in this process. Memory is capped by the total number of
+    # cached segments; least recently used entries are dropped first
+    def __init__(self, max_segments=200000):
+        self.max_segments = max_segments
+        self.entries = OrderedDict()
+        self.segments = 0
+        self.hits = 0
+        self.misses = 0
+    def clear(self):
+        self.entries.clear()
+        self.segments = 0
+    def get(self, key, parse):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        paths = parse()
+        cost = sum(len(p.segments) for p in paths)
+        if cost <= self.max_segments:
+            self.entries[key] = (paths, cost)
+            self.segments += cost
+            while self.segments > self.max_segments:
+                _, (_, dropped) = self.entries.popitem(last=False)
+                self.segments -= dropped
+        return paths
+
+path_cache = PathCache()
+
+
+NUMBER = r"[-+]?\d+\.\d+[eE][+-]?\d+|[-+]?\d+\.\d+|[-+]?\.\d+[eE][+-]?\d+|[-+]?\.\d+|[-+]?\d+\.?[eE][+-]?\d+|[-+]?\d+\.?"
+# one token with its surrounding separators; group 1 is a number, group 2 a command
+PATH_TOKEN = re.compile(r"[ \r\n\t]*(?:(%s)|([MmZzLlHhVvCcSsQqTtAa]))[, \r\n\t]*"%NUMBER)
+POINTS_TOKEN = re.compile(r"[ \r\n\t]*(%s)[, \r\n\t]*"%NUMBER)
+
+def tokenize(data, token_re):
+    # single pass over path data; numbers come out as floats, commands as strings
+    tokens = []
+    match = token_re.match
+    pos = 0
+    end = len(data)
+    while pos < end:
+        m = match(data, pos)
+        if m is None:
+            raise ValueError("Invalid SVG path expression: %r"%data)
+        if m.lastindex == 1:
+            tokens.append(float(m.group(1)))
+        else:
+            tokens.append(m.group(2))
+        pos = m.end()
+    return tokens
+
+
 class SVGPath(object):
     def __init__(self, data=None):
         self.subpaths = []
@@ -233,31 +336,25 @@ class SVGPath(object):
             self.parse(data)
 
     def poptok(self):
-        if not self.tokens:
+        if self.pos >= len(self.tokens):
             raise ValueError("Expected token but got end of path data")
-        return self.tokens.pop(0)
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
     def peektok(self):
-        if not self.tokens:
+        if self.pos >= len(self.tokens):
             raise ValueError("Expected token but got end of path data")
-        return self.tokens[0]
+        return self.tokens[self.pos]
     def popnum(self):
-        tok = self.tokens.pop(0)
-        try:
-            return float(tok)
-        except ValueError:
+        tok = self.poptok()
+        if not isinstance(tok, float):
             raise ValueError("Invalid SVG path numerical token: %s"%tok)
+        return tok
     def isnum(self):
-        if not self.tokens:
-            return False # no more tokens is considered a non-number
-        try:
-            float(self.peektok())
-        except ValueError:
-            return False
-        return True
+        # no more tokens is considered a non-number
+        return self.pos < len(self.tokens) and isinstance(self.tokens[self.pos], float)
     def popcoord(self,rel=False, cur=None):
         x = self.popnum()
-        if self.peektok() == ',':
-            self.poptok()
         y = self.popnum()
         if rel:
             x += cur[0]
@@ -275,7 +372,8 @@ class SVGPath(object):
         dot = ux*vx + uy*vy
         ul = math.sqrt(ux**2 + uy**2)
         vl = math.sqrt(vx**2 + vy**2)
-        a = math.acos(dot/(ul*vl))
+        # rounding can push the cosine just past +-1
+        a = math.acos(max(-1.0, min(1.0, dot/(ul*vl))))
         return math.copysign(a, ux*vy - uy*vx)
     def arc_eval(self, cx, cy, rx, ry, phi, w):
         # evaluate a point on an arc
@@ -346,11 +444,8 @@ class SVGPath(object):
         return self.arc_to_beziers(cx, cy, rx, ry, phi, w1, dw)
 
     def parse(self, data):
-        ds = re.split(r"[ \r\n\t]*([-+]?\d+\.\d+[eE][+-]?\d+|[-+]?\d+\.\d+|[-+]?\.\d+[eE][+-]?\d+|[-+]?\.\d+|[-+]?\d+\.?[eE][+-]?\d+|[-+]?\d+\.?|[MmZzLlHhVvCcSsQqTtAa])[, \r\n\t]*", data)
-        tokens = ds[1::2]
-        if any(ds[::2]) or not all(ds[1::2]):
-            raise ValueError("Invalid SVG path expression: %r"%data)
-        self.tokens = tokens
+        self.tokens = tokenize(data, PATH_TOKEN)
+        self.pos = 0
 
         cur = (0,0)
         curcpc = (0,0)
@@ -359,19 +454,19 @@ class SVGPath(object):
         in_path = False
         cmd = None
         subpath = LaserPath()
-        while tokens:
-            if self.isnum() and cmd in "MmLlHhVvCcSsQqTtAa":
+        while self.pos < len(self.tokens):
+            if self.isnum() and cmd is not None and cmd in "MmLlHhVvCcSsQqTtAa":
                 pass
-            elif self.peektok() in "MmZzLlHhVvCcSsQqTtAa":
-                cmd = tokens.pop(0)
+            elif not self.isnum():
+                cmd = self.poptok()
             else:
-                raise ValueError("Invalid SVG path token %s"%tok)
+                raise ValueError("Invalid SVG path token %s"%self.peektok())
 
             rel = cmd.upper() != cmd
             ucmd = cmd.upper()
 
             if not in_path and ucmd != 'M' :
-                raise ValueErorr("SVG path segment must begin with 'm' command, not '%s'"%cmd)
+                raise ValueError("SVG path segment must begin with 'm' command, not '%s'"%cmd)
 
             if ucmd == 'M':
                 sp_start = self.popcoord(rel, cur)
@@ -382,7 +477,6 @@ class SVGPath(object):
                 cur = curcpc = curcpq = sp_start
                 in_path = True
             elif ucmd == 'Z':
-                print(sp_start, cur)
                 if (sp_start[0] - cur[0]) > 0.0000001 or (sp_start[1] - cur[1]) > 0.0000001:
                     subpath.add(PathLine(cur, sp_start))
                 cur = curcpc = curcpq = sp_start
@@ -450,16 +544,12 @@ class SVGPolyline(SVGPath):
         if data:
             self.parse(data, close)
     def parse(self, data, close=False):
-        ds = re.split(r"[ \r\n\t]*([-+]?\d+\.\d+[eE][+-]?\d+|[-+]?\d+\.\d+|[-+]?\.\d+[eE][+-]?\d+|[-+]?\.\d+|[-+]?\d+\.?[eE][+-]?\d+|[-+]?\d+\.?)[, \r\n\t]*", data)
-        tokens = ds[1::2]
-        if any(ds[::2]) or not all(ds[1::2]):
-            raise ValueError("Invalid SVG path expression: %r"%data)
-
-        self.tokens = tokens
+        self.tokens = tokenize(data, POINTS_TOKEN)
+        self.pos = 0
         cur = None
         first = None
         subpath = LaserPath()
-        while tokens:
+        while self.pos < len(self.tokens):
             pt = self.popcoord()
             if first is None:
                 first = pt